@@ -1,21 +1,31 @@
 from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form, Depends, Header
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.utils import is_body_allowed_for_status_code
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+import httpx
 import uuid
 import time
 import json
+import orjson
+import asyncio
 import os
 import warnings
-import sqlite3
+import aiosqlite
 import re
 import html
 import logging
+import queue
+import atexit
 import sys
 import hmac
 import hashlib
+from aiosqlitepool import SQLiteConnectionPool
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
-from typing import Dict, List, Optional, Any, Generator
+from typing import Dict, List, Optional, Any, Generator, Union
 from pydantic import BaseModel
 
 # 加载 .env 文件中的环境变量
@@ -26,21 +36,27 @@ def setup_logging():
     """设置日志配置"""
     # 创建日志目录
     log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
     
     # 配置日志格式
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s'
     
-    # 配置根日志记录器
-    logging.basicConfig(
-        level=logging.INFO,
-        format=log_format,
-        handlers=[
-            logging.FileHandler(f'{log_dir}/qwen_fastapi.py.log', encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    formatter = logging.Formatter(log_format)
+    file_handler = logging.FileHandler(f'{log_dir}/qwen_fastapi.py.log', encoding='utf-8')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    # 实际的文件/控制台写入交给后台线程的 QueueListener，请求路径上只做入队
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    # 配置根日志记录器（只挂载 QueueHandler）
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
     
     # 创建专用日志记录器
     logger = logging.getLogger('qwen_fastapi.py')
@@ -58,30 +74,51 @@ QWEN_COOKIES = os.environ.get("QWEN_COOKIES", "")
 class CookieManager:
     """Cookie管理器 - 简化版本"""
 
-    # 关键Cookie参数列表
-    ESSENTIAL_PARAMS = [
+    __slots__ = ('_cookies', '_essential_cached')
+
+    # 关键Cookie参数集合（frozenset，成员检查为O(1)；名称经 sys.intern 驻留，
+    # 含 '-' 的名称如 'x-ap' 不会被自动驻留）
+    ESSENTIAL_PARAMS = frozenset(map(sys.intern, (
         'cnaui', 'aui', 'sca', 'xlly_s', '_gcl_au', 'cna',  # 长期参数
         'token', '_bl_uid', 'x-ap',  # 中期参数
         'acw_tc', 'atpsida', 'tfstk', 'ssxmod_itna'  # 短期参数
-    ]
+    )))
+
+    # 必须存在的Cookie参数（元组保持报告顺序稳定，不在每次调用时重建）
+    CRITICAL_PARAMS = tuple(map(sys.intern, ('cnaui', 'aui', 'token')))
+
+    # 一次匹配一个 key=value 对，值两端的空白不计入
+    _COOKIE_RE = re.compile(r'\s*([^=;\s]+)=([^;]*?)\s*(?:;|$)')
 
     def __init__(self, cookie_string=""):
         self.cookies = self._parse_cookies(cookie_string)
 
+    @property
+    def cookies(self):
+        return self._cookies
+
+    @cookies.setter
+    def cookies(self, value):
+        self._cookies = value
+        # Cookie变更后清空序列化缓存
+        self._essential_cached = None
+
+    @property
+    def essential_cookie_string(self):
+        """关键Cookie参数的序列化字符串（缓存，Cookie变更时失效）"""
+        if self._essential_cached is None:
+            self._essential_cached = '; '.join([f"{k}={v}" for k, v in self.get_essential_cookies().items()])
+        return self._essential_cached
+
     def _parse_cookies(self, cookie_string):
-        """解析Cookie字符串为字典"""
-        cookies = {}
-        if cookie_string:
-            for item in cookie_string.split(';'):
-                if '=' in item:
-                    key, value = item.strip().split('=', 1)
-                    cookies[key] = value
-        return cookies
+        """解析Cookie字符串为字典（单次正则扫描，键名驻留以便与关键参数按指针比较）"""
+        if not cookie_string:
+            return {}
+        return {sys.intern(k): v for k, v in self._COOKIE_RE.findall(cookie_string)}
 
     def get_cookie_status(self):
         """检查Cookie状态 - 简化版本"""
-        critical_params = ['cnaui', 'aui', 'token']
-        missing_critical = [p for p in critical_params if p not in self.cookies]
+        missing_critical = [p for p in self.CRITICAL_PARAMS if p not in self.cookies]
 
         return {
             'healthy': len(missing_critical) == 0,
@@ -95,7 +132,7 @@ class CookieManager:
     def to_cookie_string(self, cookies_dict=None):
         """转换为Cookie字符串"""
         if cookies_dict is None:
-            cookies_dict = self.get_essential_cookies()
+            return self.essential_cookie_string
         return '; '.join([f"{k}={v}" for k, v in cookies_dict.items()])
 
     def extract_token(self):
@@ -124,7 +161,9 @@ if not QWEN_AUTH_TOKEN:
 
 IS_DELETE = 0  # 是否在会话结束后自动删除会话
 PORT = 8000  # FastAPI默认端口
-DEBUG_STATUS = True  # 开启debug模式以便观察上传过程
+# 是否开启debug模式（通过环境变量 DEBUG_STATUS 配置，默认关闭）；
+# 请求热路径上的 debug_log 调用先检查该开关，关闭时连日志字符串都不会格式化
+DEBUG_STATUS = os.environ.get("DEBUG_STATUS", "false").lower() in ("1", "true", "yes", "on")
 DATABASE_PATH = "db/chat_history.db"  # 数据库文件路径
 
 # ==================== API鉴权配置 ====================
@@ -138,12 +177,16 @@ if VALID_TOKENS_STR:
         logger.info(f"✅ 已加载 {len(VALID_TOKENS)} 个有效API Token")
     except json.JSONDecodeError:
         # 如果不是JSON格式，尝试按逗号分隔
-        VALID_TOKENS = [token.strip() for token in VALID_TOKENS_STR.split(',') if token.strip()]
+        VALID_TOKENS = [token for token in (t.strip() for t in VALID_TOKENS_STR.split(',')) if token]
         logger.info(f"✅ 已加载 {len(VALID_TOKENS)} 个有效API Token (逗号分隔)")
 else:
     logger.warning("⚠️  未配置VALID_TOKENS，API将不进行鉴权验证")
 
-def verify_auth_token(authorization: str = Header(None)):
+# 预先计算有效token的SHA-256摘要集合，鉴权时O(1)查找；
+# 集合中比较的是摘要而非原始token，不会泄露token本身的时序信息
+VALID_TOKEN_DIGESTS = frozenset(hashlib.sha256(token.encode()).digest() for token in VALID_TOKENS)
+
+def verify_auth_token(authorization: str = Header(None, convert_underscores=False)):
     """验证 Authorization Header 中的 Bearer Token
 
     Args:
@@ -166,29 +209,45 @@ def verify_auth_token(authorization: str = Header(None)):
             detail="Missing Authorization Header. Please provide a valid Bearer token."
         )
 
-    # 解析Bearer token
-    scheme, _, token = authorization.partition(" ")
-    if scheme.lower() != "bearer":
+    token = _check_authorization(authorization)
+    logger.debug(f"✅ 鉴权成功: token {token[:10]}...")
+    return token
+
+@lru_cache(maxsize=1024)
+def _check_authorization(authorization: str) -> str:
+    """解析并校验 Authorization Header，返回token
+
+    只有校验通过的结果会被缓存（抛出的异常不会进入缓存），
+    因此同一客户端重复携带的合法token只需一次字典查找。
+    """
+    # 解析Bearer token（常规写法直接前缀切片，大小写不同的写法才走较慢的分支）
+    if authorization.startswith("Bearer ") or authorization[:7].casefold() == "bearer ":
+        token = authorization[7:]
+    else:
+        scheme = authorization.partition(" ")[0]
         logger.warning(f"🔒 鉴权失败: 无效的Authorization Scheme: {scheme}")
         raise HTTPException(
             status_code=401,
             detail="Invalid Authorization Scheme. Expected 'Bearer <token>'"
         )
 
-    # 验证token是否在有效列表中
-    if token not in VALID_TOKENS:
+    # 验证token是否在有效列表中（按摘要查找，避免随token数量线性增长的扫描和时序侧信道）
+    if hashlib.sha256(token.encode()).digest() not in VALID_TOKEN_DIGESTS:
         logger.warning(f"🔒 鉴权失败: 无效或过期的token: {token[:10]}...")
         raise HTTPException(
             status_code=403,
             detail="Invalid or Expired Token. Access denied."
         )
 
-    logger.debug(f"✅ 鉴权成功: token {token[:10]}...")
     return token
+
+# 复用的鉴权依赖，各路由共享同一个 Depends 对象
+AUTH = Depends(verify_auth_token)
 # ==================== API鉴权配置结束 ====================
 
 # 模型映射，基于实际返回的模型列表（model.txt）
-MODEL_MAP = {
+# 以只读视图导出，键值经 sys.intern 驻留，防止运行时被意外修改
+MODEL_MAP = MappingProxyType({sys.intern(k): sys.intern(v) for k, v in {
     # 基于 model.txt 中实际存在的模型ID进行映射
     "qwen": "qwen3-max",                        # 默认旗舰模型
     "qwen3": "qwen3-max",                       # Qwen3 默认模型
@@ -221,113 +280,338 @@ MODEL_MAP = {
     "gpt-3.5-turbo": "qwen-turbo-2025-02-11",  # 快速高效
     "gpt-4": "qwen-plus-2025-09-11",           # 复杂任务
     "gpt-4-turbo": "qwen3-max",                # 最强大
-}
+}.items()})
 # =================================================
 
 warnings.filterwarnings("ignore", message=".*development server.*")
 
-def debug_log(message):
-    """根据DEBUG_STATUS决定是否输出debug信息"""
-    if DEBUG_STATUS:
-        logger.debug(f"[DEBUG] {message}")
+# DEBUG_STATUS 在启动时由环境变量确定、运行期间不变，因此在导入时直接选定 debug_log 的实现：
+# 关闭时为空函数（调用处的参数仍会求值，热路径上的调用另外用 if DEBUG_STATUS 包裹）
+if DEBUG_STATUS:
+    def debug_log(message):
+        """输出debug信息"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[DEBUG] {message}")
+else:
+    def debug_log(message):
+        """DEBUG_STATUS 关闭时不输出debug信息"""
+
+# 预编译的正则表达式（模块加载时编译一次，热路径直接调用绑定方法）
+# 匹配 <tool_use>...</tool_use>，re.DOTALL 使得 . 可以匹配换行符
+_TOOL_USE_RE = re.compile(r'<tool_use>.*?</tool_use>', re.DOTALL)
+_WS_RE = re.compile(r'\s+')
+# OSS 初始化分块上传响应中的 UploadId（只需这一个字段，无需构建XML树）
+_UPLOAD_ID_RE = re.compile(rb'<UploadId>([^<]+)</UploadId>')
+
+# normalize_text 中需要删除的字符：常见markdown符号与emoji（str.translate 删除表）
+_NORMALIZE_DELETE_TABLE = dict.fromkeys([
+    *map(ord, '*_`~✨🌟'),
+    *range(0x1F600, 0x1F650),  # 表情符号
+    *range(0x1F300, 0x1F600),  # 杂项符号和象形文字
+    *range(0x1F680, 0x1F700),  # 交通和地图符号
+    *range(0x1F1E0, 0x1F200),  # 区域指示符号（国旗）
+])
+
+# 聊天请求负载中固定不变的部分（只读，构建负载时展开后再填入动态字段）
+_CHAT_PAYLOAD_TEMPLATE = MappingProxyType({
+    "stream": True,  # 始终使用流式以获取实时数据
+    "incremental_output": True,  # 关键字段
+    "chat_mode": "normal",
+})
+_CHAT_MESSAGE_TEMPLATE = MappingProxyType({
+    "role": "user",
+    "user_action": "chat",
+    "chat_type": "t2t",
+    "extra": {"meta": {"subChatType": "t2t"}},
+    "sub_chat_type": "t2t",
+})
+# 不带 thinking_budget 时的两种 feature_config，所有请求共享（orjson 不支持 MappingProxyType，直接作为只读使用）
+_FEATURE_CONFIG_THINKING_OFF = {"output_schema": "phase", "thinking_enabled": False}
+_FEATURE_CONFIG_THINKING_ON = {"output_schema": "phase", "thinking_enabled": True}
+# 聊天请求的附加请求头，对于流式响应很重要
+_CHAT_STREAM_HEADERS = MappingProxyType({"x-accel-buffering": "no"})
+
+# SSE 输出直接以 bytes 产出，省去 str -> bytes 的再次编码
+SSE_DONE = b"data: [DONE]\n\n"
+# 解析上游 SSE 时使用的字节常量，逐行比较时无需解码
+_SSE_DATA_PREFIX = b"data: "
+_SSE_DONE_MARKER = b"[DONE]"
+
+def sse_event(data) -> bytes:
+    """将对象序列化为一条 SSE data 事件"""
+    return _SSE_DATA_PREFIX + orjson.dumps(data) + b"\n\n"
 
 def remove_tool(text):
-    # 使用正则表达式匹配 <tool_use>...</tool_use>，包括跨行内容
-    pattern = r'<tool_use>.*?</tool_use>'
-    # flags=re.DOTALL 使得 . 可以匹配换行符
-    cleaned_text = re.sub(pattern, '', text, flags=re.DOTALL)
-    return cleaned_text
+    # 去除 <tool_use>...</tool_use>，包括跨行内容
+    return _TOOL_USE_RE.sub('', text)
+
+def last_message_by_role(messages: list, role: str):
+    """从后向前查找指定角色的最新一条消息，找不到时返回 None"""
+    for i in range(len(messages) - 1, -1, -1):
+        msg = messages[i]
+        if msg.get('role') == role:
+            return msg
+    return None
+
+def _format_uuid4(b: bytearray) -> str:
+    """将16字节随机数设置版本/变体位后格式化为标准UUID4字符串"""
+    b[6] = (b[6] & 0x0f) | 0x40
+    b[8] = (b[8] & 0x3f) | 0x80
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def fast_uuid4_pair() -> tuple:
+    """一次读取32字节随机数生成两个UUID4字符串，省去 uuid.UUID 对象的构造"""
+    b = os.urandom(32)
+    return _format_uuid4(bytearray(b[:16])), _format_uuid4(bytearray(b[16:]))
+
+def fast_uuid4_triple() -> tuple:
+    """一次读取48字节随机数生成三个UUID4字符串"""
+    b = os.urandom(48)
+    return _format_uuid4(bytearray(b[:16])), _format_uuid4(bytearray(b[16:32])), _format_uuid4(bytearray(b[32:]))
+
+# 视频文件扩展名
+_VIDEO_EXT_SET = frozenset({'.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv', '.m4v', '.3gp', '.m2ts', '.qt'})
+
+# 图片上传接口使用的扩展名到Content-Type映射
+_IMAGE_EXT_TO_MIME = MappingProxyType({
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.bmp': 'image/bmp',
+    '.tiff': 'image/tiff',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon'
+})
+
+# 扩展名到Content-Type的映射（模块加载时构建一次）
+_EXT_TO_MIME = {
+    # 图片格式
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+    '.png': 'image/png', '.gif': 'image/gif',
+    '.webp': 'image/webp', '.bmp': 'image/bmp',
+    '.tiff': 'image/tiff',
+
+    # 视频格式
+    '.mp4': 'video/mp4', '.avi': 'video/x-msvideo',
+    '.mov': 'video/quicktime', '.qt': 'video/quicktime',
+    '.wmv': 'video/x-ms-wmv', '.flv': 'video/x-flv',
+    '.webm': 'video/webm', '.mkv': 'video/x-matroska',
+    '.m4v': 'video/x-m4v', '.3gp': 'video/3gpp',
+    '.m2ts': 'video/mp2t',
 
+    # 文档格式
+    '.pdf': 'application/pdf',
+    '.doc': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.xls': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.ppt': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+
+    # 文本格式
+    '.txt': 'text/plain', '.md': 'text/markdown',
+    '.csv': 'text/csv', '.json': 'application/json',
+    '.xml': 'application/xml', '.yaml': 'application/x-yaml',
+    '.yml': 'application/x-yaml',
+}
+
+def _file_ext(filename: str) -> str:
+    """小写的文件扩展名（含 '.'），语义与 os.path.splitext 相同：忽略路径部分和开头的 '.'"""
+    base = filename.rpartition('/')[2]
+    _, dot, ext = base.lstrip('.').rpartition('.')
+    return ('.' + ext).lower() if dot else ''
+
+@lru_cache(maxsize=1024)
 def determine_filetype(filename: str, content_type: str = None) -> str:
     """
     根据文件名和Content-Type确定Qwen API的filetype参数
     返回: "image", "video", 或 "file"
     """
-    file_ext = os.path.splitext(filename)[1].lower() if filename else ""
-
     # 图片类型
     if (content_type and content_type.startswith('image/')):
         return "image"
 
     # 视频类型
-    video_extensions = ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv', '.m4v', '.3gp', '.m2ts', '.qt']
-    if (content_type and content_type.startswith('video/')) or file_ext in video_extensions:
+    if content_type and content_type.startswith('video/'):
+        return "video"
+    file_ext = _file_ext(filename) if filename else ""
+    if file_ext in _VIDEO_EXT_SET:
         return "video"
 
     # 其他所有文件类型统一为 "file"
     return "file"
 
+@lru_cache(maxsize=1024)
 def determine_content_type(filename: str, provided_content_type: str = None) -> str:
     """
     根据文件名扩展名确定详细的Content-Type
     如果提供了content_type则作为后备返回值
     """
-    if not filename:
-        return provided_content_type or "application/octet-stream"
+    file_ext = _file_ext(filename) if filename else ""
+
+    # 未知扩展名时使用提供的content_type或默认值
+    return _EXT_TO_MIME.get(file_ext) or provided_content_type or "application/octet-stream"
+
+def upload_file_size(upload: UploadFile) -> int:
+    """获取上传文件大小：优先使用解析multipart时记录的大小，不预先把整个文件读入内存"""
+    if upload.size is not None:
+        return upload.size
+    size = upload.file.seek(0, os.SEEK_END)
+    upload.file.seek(0)
+    return size
+
+# generate_smart_prompt 使用的文件类型位标记
+_HAS_IMAGE, _HAS_VIDEO, _HAS_PDF, _HAS_OFFICE, _HAS_TEXT, _HAS_JSON, _HAS_XML = (1 << i for i in range(7))
+_OFFICE_TOKENS = ('word', 'excel', 'powerpoint', 'spreadsheet', 'presentation')
+# 按固定顺序排列的 (位标记, 提示语片段)
+_SMART_PROMPTS = (
+    (_HAS_IMAGE, "识别图片中的内容和信息"),
+    (_HAS_VIDEO, "分析视频内容、场景信息和关键画面"),
+    (_HAS_PDF, "解析PDF文档中的文本内容和结构信息"),
+    (_HAS_OFFICE, "分析Office文档(Word/Excel/PowerPoint)的内容和数据"),
+    (_HAS_TEXT, "处理文本文件的内容"),
+    (_HAS_JSON, "解析JSON数据结构和内容"),
+    (_HAS_XML, "解析XML文档结构和数据"),
+)
 
-    file_ext = os.path.splitext(filename)[1].lower()
+class StreamAccumulator:
+    """流式聊天的状态：按 phase 分派上游增量，累积回复内容并生成需要转发的 OpenAI 流式块"""
+
+    __slots__ = ('chat_id', 'model', 'reasoning_parts', 'assistant_parts', 'finish_reason', '_dispatch',
+                 '_chunk_tmpl', '_choice', '_delta')
+
+    def __init__(self, chat_id: str, model: str, created: int):
+        self.chat_id = chat_id
+        self.model = model
+        self.reasoning_parts = []  # 用于累积 thinking 阶段的内容片段
+        self.assistant_parts = []  # 用于累积assistant回复内容片段
+        self.finish_reason = "stop"
+        self._dispatch = {"think": self._on_think, "answer": self._on_answer, None: self._on_untagged}
+        # 每个请求只构建一次流式块模板，之后仅修改 delta / finish_reason；
+        # 返回的块会被复用，调用方需在下一次 feed 之前完成序列化
+        self._delta = {}
+        self._choice = {"index": 0, "delta": self._delta, "finish_reason": None}
+        self._chunk_tmpl = {
+            "id": f"chatcmpl-{chat_id[:10]}",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [self._choice]
+        }
 
-    # 图片格式
-    image_types = {
-        '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
-        '.png': 'image/png', '.gif': 'image/gif',
-        '.webp': 'image/webp', '.bmp': 'image/bmp',
-        '.tiff': 'image/tiff'
-    }
-    if file_ext in image_types:
-        return image_types[file_ext]
+    def feed(self, delta: dict) -> Optional[dict]:
+        """处理一个上游 delta，返回需要转发给客户端的流式块（没有则返回 None）"""
+        phase = delta.get("phase")
+        content = delta.get("content", "")
+        finished = delta.get("status") == "finished"
+        handler = self._dispatch.get(phase)
+        openai_chunk = handler(content, finished) if handler else None
+        # 处理结束信号 (通常在 answer 阶段的最后一个块)
+        if finished:
+            self.finish_reason = delta.get("finish_reason", "stop")
+        return openai_chunk
+
+    def _on_think(self, content: str, finished: bool):
+        # think 阶段的内容不直接发送，只累积（空内容不记录，避免向 answer 块附带空的 reasoning_content）
+        if content and not finished:
+            self.reasoning_parts.append(content)
+        return None
 
-    # 视频格式
-    video_types = {
-        '.mp4': 'video/mp4', '.avi': 'video/x-msvideo',
-        '.mov': 'video/quicktime', '.qt': 'video/quicktime',
-        '.wmv': 'video/x-ms-wmv', '.flv': 'video/x-flv',
-        '.webm': 'video/webm', '.mkv': 'video/x-matroska',
-        '.m4v': 'video/x-m4v', '.3gp': 'video/3gpp',
-        '.m2ts': 'video/mp2t'
-    }
-    if file_ext in video_types:
-        return video_types[file_ext]
+    def _on_untagged(self, content: str, finished: bool) -> Optional[dict]:
+        # 无明确 phase 但有内容时按 answer 处理 (兼容性)
+        return self._on_answer(content, finished) if content else None
+
+    def _on_answer(self, content: str, finished: bool) -> dict:
+        self.assistant_parts.append(content)  # 累积assistant回复
+        delta_ref = self._delta
+        delta_ref["content"] = content  # answer 阶段进行中不设 finish_reason
+        # 如果累积了推理内容，则在第一个 answer 块中附带
+        if self.reasoning_parts:
+            delta_ref["reasoning_content"] = "".join(self.reasoning_parts)
+            self.reasoning_parts = []  # 发送后清空
+        else:
+            delta_ref.pop("reasoning_content", None)
+        return self._chunk_tmpl
 
-    # 文档格式
-    document_types = {
-        '.pdf': 'application/pdf',
-        '.doc': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        '.xls': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        '.ppt': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-        '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-    }
-    if file_ext in document_types:
-        return document_types[file_ext]
+    def final_chunk(self) -> dict:
+        """结束时发送的消息块，包含 finish_reason"""
+        self._delta.clear()
+        self._choice["finish_reason"] = self.finish_reason
+        return self._chunk_tmpl
 
-    # 文本格式
-    text_types = {
-        '.txt': 'text/plain', '.md': 'text/markdown',
-        '.csv': 'text/csv', '.json': 'application/json',
-        '.xml': 'application/xml', '.yaml': 'application/x-yaml',
-        '.yml': 'application/x-yaml'
-    }
-    if file_ext in text_types:
-        return text_types[file_ext]
+    def error_chunk(self, message: str) -> dict:
+        """流式请求出错时发送的消息块，复用模板中的 object/created/model 字段"""
+        return {**self._chunk_tmpl, "id": "chatcmpl-error",
+                "choices": [{"index": 0, "delta": {"content": message}, "finish_reason": "error"}]}
 
-    # 使用提供的content_type或默认值
-    return provided_content_type or "application/octet-stream"
+    def assistant_content(self) -> str:
+        return "".join(self.assistant_parts)
 
 class ChatHistoryManager:
     """管理聊天历史记录的本地存储"""
     
-    def __init__(self, db_path: str):
+    # 会话记录的写入语句（单条与批量写入共用）
+    _UPSERT_SQL = '''
+        INSERT OR REPLACE INTO chat_sessions 
+        (chat_id, title, created_at, updated_at, chat_type, current_response_id, 
+         last_assistant_content, normalized_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    def __init__(self, db_path: str, pool_size: int = 5):
         self.db_path = db_path
-        self.init_database()
+        # 使用 aiosqlite 连接池复用连接，数据库操作不再阻塞事件循环
+        self.pool = SQLiteConnectionPool(self._connection_factory, pool_size=pool_size)
+        self._sync_lock_file = None
     
-    def init_database(self):
-        """初始化数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
+    async def _connection_factory(self):
+        """为连接池创建新的数据库连接，并应用WAL模式及性能相关的PRAGMA"""
+        # isolation_level=None：单条语句自动提交，需要原子性的多语句写入显式 BEGIN/COMMIT
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        # WAL模式下读操作不会被写操作阻塞，避免 "database is locked"
+        await conn.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下NORMAL同步级别可安全减少fsync次数
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        await conn.execute("PRAGMA cache_size=-64000")  # 约64MB页缓存
+        return conn
+    
+    async def close(self):
+        """关闭连接池中的所有数据库连接"""
+        await self.pool.close()
+        if self._sync_lock_file is not None:
+            self._sync_lock_file.close()
+            self._sync_lock_file = None
+    
+    def acquire_sync_lock(self) -> bool:
+        """尝试获取云端历史同步锁，获取成功返回 True
+        
+        多进程（--workers）部署时所有工作进程共用同一个数据库，只由拿到锁的进程清空并重建会话记录；
+        锁在进程存活期间一直持有，进程退出时由操作系统释放
+        """
+        lock_file = open(f"{self.db_path}.sync.lock", "w")
         try:
-            cursor = conn.cursor()
-            cursor.execute('''
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._sync_lock_file = lock_file
+        return True
+    
+    async def init_database(self):
+        """初始化数据库表结构"""
+        async with self.pool.connection() as conn:
+            await conn.execute('BEGIN')
+            await conn.execute('''
                 CREATE TABLE IF NOT EXISTS chat_sessions (
                     chat_id TEXT PRIMARY KEY,
                     title TEXT,
@@ -335,89 +619,127 @@ class ChatHistoryManager:
                     updated_at INTEGER,
                     chat_type TEXT,
                     current_response_id TEXT,
-                    last_assistant_content TEXT
+                    last_assistant_content TEXT,
+                    normalized_hash TEXT
                 )
             ''')
-            conn.commit()
+            # 旧版本数据库没有 normalized_hash 列，补充该列并回填已有记录
+            cursor = await conn.execute('PRAGMA table_info(chat_sessions)')
+            columns = {row[1] for row in await cursor.fetchall()}
+            if 'normalized_hash' not in columns:
+                await conn.execute('ALTER TABLE chat_sessions ADD COLUMN normalized_hash TEXT')
+                cursor = await conn.execute('''
+                    SELECT chat_id, last_assistant_content FROM chat_sessions
+                    WHERE last_assistant_content IS NOT NULL
+                ''')
+                await conn.executemany(
+                    'UPDATE chat_sessions SET normalized_hash = ? WHERE chat_id = ?',
+                    [(self.content_hash(content), chat_id) for chat_id, content in await cursor.fetchall()]
+                )
+                debug_log("已为旧数据库添加 normalized_hash 列")
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_norm_hash ON chat_sessions(normalized_hash)')
+            await conn.execute('COMMIT')
             debug_log("数据库初始化完成")
-        finally:
-            conn.close()
     
-    def update_session(self, chat_id: str, title: str, created_at: int, updated_at: int, 
-                      chat_type: str, current_response_id: str, last_assistant_content: str):
+    async def update_session(self, chat_id: str, title: str, created_at: int, updated_at: int, 
+                             chat_type: str, current_response_id: str, last_assistant_content: str):
         """更新或插入会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_sessions 
-                (chat_id, title, created_at, updated_at, chat_type, current_response_id, 
-                 last_assistant_content)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (chat_id, title, created_at, updated_at, chat_type, current_response_id,
-                  remove_tool(last_assistant_content)))
-            conn.commit()
-            debug_log(f"更新会话记录: {chat_id}")
-        finally:
-            conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute(self._UPSERT_SQL, self._session_row(
+                chat_id, title, created_at, updated_at, chat_type, current_response_id,
+                last_assistant_content))
+            if DEBUG_STATUS:
+                debug_log(f"更新会话记录: {chat_id}")
     
-    def get_session_by_last_content(self, content: str):
-        """根据最新AI回复内容查找会话"""
-        normalized_content = self.normalize_text(content)
-        debug_log(f"查找会话，标准化内容: {normalized_content[:100]}...")
+    async def bulk_update_sessions(self, rows):
+        """在单个事务中批量更新或插入会话记录
+
+        Args:
+            rows: (chat_id, title, created_at, updated_at, chat_type,
+                   current_response_id, last_assistant_content) 元组的列表
+        """
+        if not rows:
+            return
+        async with self.pool.connection() as conn:
+            await conn.execute('BEGIN')
+            await conn.executemany(self._UPSERT_SQL, [self._session_row(*row) for row in rows])
+            await conn.execute('COMMIT')
+            if DEBUG_STATUS:
+                debug_log(f"批量更新 {len(rows)} 条会话记录")
+    
+    @classmethod
+    def _session_row(cls, chat_id, title, created_at, updated_at, chat_type,
+                     current_response_id, last_assistant_content):
+        """构造写入 chat_sessions 的一行数据（去除工具调用内容并计算摘要）"""
+        content = remove_tool(last_assistant_content)
+        return (chat_id, title, created_at, updated_at, chat_type, current_response_id,
+                content, cls.content_hash(content))
+    
+    async def get_session_by_last_content(self, content: str):
+        """根据最新AI回复内容查找会话（按标准化内容的哈希走索引查找）"""
+        if DEBUG_STATUS:
+            debug_log(f"查找会话，内容: {content[:100]}...")
         
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT chat_id, current_response_id, last_assistant_content
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute('''
+                SELECT chat_id, current_response_id
                 FROM chat_sessions 
-                WHERE last_assistant_content IS NOT NULL
-            ''')
-            results = cursor.fetchall()
-            
-            debug_log(f"数据库中共有 {len(results)} 条会话记录")
-            
-            for row in results:
-                chat_id, current_response_id, stored_content = row
-                normalized_stored = self.normalize_text(stored_content)
-                debug_log(f"比较会话 {chat_id}...")
-                
-                if normalized_content == normalized_stored:
-                    debug_log(f"匹配成功！会话ID: {chat_id}")
-                    return {
-                        'chat_id': chat_id,
-                        'current_response_id': current_response_id
-                    }
-            
-            debug_log("未找到匹配的会话")
-            return None
-        finally:
-            conn.close()
+                WHERE normalized_hash = ?
+                LIMIT 1
+            ''', (self.content_hash(content),))
+            row = await cursor.fetchone()
+        
+        if row:
+            chat_id, current_response_id = row
+            if DEBUG_STATUS:
+                debug_log(f"匹配成功！会话ID: {chat_id}")
+            return {
+                'chat_id': chat_id,
+                'current_response_id': current_response_id
+            }
+        
+        debug_log("未找到匹配的会话")
+        return None
+    
+    async def iter_sessions(self):
+        """逐行遍历所有会话记录（按更新时间倒序），不一次性加载整个结果集"""
+        async with self.pool.connection() as conn:
+            async with conn.execute('''
+                SELECT chat_id, title, created_at, updated_at, chat_type,
+                       current_response_id, last_assistant_content
+                FROM chat_sessions
+                ORDER BY updated_at DESC
+            ''') as cursor:
+                cursor.row_factory = aiosqlite.Row
+                async for row in cursor:
+                    yield dict(row)
     
-    def delete_session(self, chat_id: str):
+    async def delete_session(self, chat_id: str):
         """删除会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
-            conn.commit()
-            debug_log(f"删除会话记录: {chat_id}")
-        finally:
-            conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
+            if DEBUG_STATUS:
+                debug_log(f"删除会话记录: {chat_id}")
     
-    def clear_all_sessions(self):
+    async def clear_all_sessions(self):
         """清空所有会话记录"""
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM chat_sessions')
-            conn.commit()
+        async with self.pool.connection() as conn:
+            await conn.execute('DELETE FROM chat_sessions')
             debug_log("清空所有会话记录")
-        finally:
-            conn.close()
     
-    def normalize_text(self, text: str) -> str:
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def content_hash(text: str) -> str:
+        """计算AI回复内容标准化后的摘要（normalized_hash 列的值）
+
+        结果按原始文本缓存：客户端原样回传的上一轮回复与写入时的内容相同，
+        查找时可直接命中缓存，省去再次标准化。
+        """
+        normalized = ChatHistoryManager.normalize_text(text)
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+    
+    @staticmethod
+    def normalize_text(text: str) -> str:
         """标准化文本，处理转义字符、空白符等"""
         if not text:
             return ""
@@ -425,24 +747,182 @@ class ChatHistoryManager:
         # HTML解码
         text = html.unescape(text)
         # 去除多余空白字符
-        text = re.sub(r'\s+', ' ', text.strip())
-        # 去除常见的markdown符号
-        text = re.sub(r'[*_`~]', '', text)
-        # 去除emoji（简单处理）
-        text = re.sub(r'[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F1E0-\U0001F1FF✨🌟]', '', text)
+        text = _WS_RE.sub(' ', text.strip())
+        # 去除常见的markdown符号和emoji（简单处理）
+        text = text.translate(_NORMALIZE_DELETE_TABLE)
         
         return text
 
+# OSS请求中固定不变的请求头（与 curlvode.txt 中浏览器发出的请求一致）
+_OSS_STATIC_HEADERS = MappingProxyType({
+    'Accept': '*/*',
+    'Accept-Language': 'zh-CN,zh;q=0.9',
+    'Connection': 'keep-alive',
+    'Origin': 'https://chat.qwen.ai',
+    'Referer': 'https://chat.qwen.ai/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'cross-site',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Not A(Brand";v="8", "Chromium";v="132", "Google Chrome";v="132"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'x-oss-content-sha256': 'UNSIGNED-PAYLOAD',
+    'x-oss-user-agent': 'aliyun-sdk-js/6.23.0 Chrome 132.0.0.0 on Windows 10 64-bit'
+})
+
+# OSS v4 签名使用的区域与服务
+_OSS_REGION = "ap-southeast-1"
+_OSS_SERVICE = "oss"
+
+# POST表单上传的大小上限：超过该大小（或视频文件）一律走分块上传，
+# POST policy 的 content-length-range 也使用同一个值，保证选择结果与OSS侧限制一致
+MULTIPART_THRESHOLD = 5 * 1024 * 1024  # 5MB
+
+def _use_multipart_upload(file_size: int, filetype: str) -> bool:
+    """根据文件大小和类型决定是否使用分块上传"""
+    return filetype == "video" or file_size > MULTIPART_THRESHOLD
+
+# 分块上传的分块大小随文件大小分级：(文件大小上限, 分块大小)，超过最后一级使用 _MULTIPART_MAX_PART_SIZE
+# 分块越大请求数越少，但单块重试代价和在途内存（分块大小 × OSS_PART_CONCURRENCY）越大
+_MULTIPART_PART_SIZE_TIERS = (
+    (20 * 1024 * 1024, 5 * 1024 * 1024),
+    (200 * 1024 * 1024, 8 * 1024 * 1024),
+    (1024 * 1024 * 1024, 16 * 1024 * 1024),
+)
+_MULTIPART_MAX_PART_SIZE = 32 * 1024 * 1024
+
+def _multipart_part_size(file_size: int) -> int:
+    """根据文件大小选择分块上传的分块大小"""
+    for size_limit, part_size in _MULTIPART_PART_SIZE_TIERS:
+        if file_size < size_limit:
+            return part_size
+    return _MULTIPART_MAX_PART_SIZE
+
+@lru_cache(maxsize=32)
+def _derive_oss_signing_key(access_key_secret: str, date_ymd: str) -> bytes:
+    """派生OSS v4签名密钥
+
+    密钥只依赖 secret 与日期（YYYYMMDD），同一STS凭据当天的多次上传直接命中缓存；
+    hmac.digest 为单次调用的C实现，不创建HMAC对象。
+    """
+    key = hmac.digest(f"aliyun_v4{access_key_secret}".encode(), date_ymd.encode(), 'sha256')
+    for scope_part in (_OSS_REGION, _OSS_SERVICE, "aliyun_v4_request"):
+        key = hmac.digest(key, scope_part.encode(), 'sha256')
+    return key
+
+# 本客户端生成的OSS URL形如 https://{bucket}.{endpoint}/{path}?{query}，拆出 host / path / query
+_OSS_URL_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]*)([^?#]*)(?:\?([^#]*))?')
+
+def _oss_canonical_uri_and_query(url: str) -> tuple:
+    """从URL解析OSS v4签名所需的 CanonicalURI 与 CanonicalQueryString"""
+    host, path, query = _OSS_URL_RE.match(url).groups()
+
+    # CanonicalQueryString - 修复查询参数处理
+    # 对于?uploads或?uploads=这种情况，应该生成"uploads"而不是空字符串
+    if query:
+        # 手动解析查询字符串，保留空值参数
+        query_parts = []
+        for param in query.split('&'):
+            if '=' in param:
+                key, value = param.split('=', 1)
+                if value:
+                    query_parts.append(f"{key}={value}")
+                else:
+                    query_parts.append(key)  # ?uploads= 情况
+            else:
+                query_parts.append(param)  # ?uploads 情况
+        canonical_querystring = '&'.join(sorted(query_parts))
+    else:
+        canonical_querystring = ''
+
+    # CanonicalURI - 修复URI处理（加速域名需要包含bucket名）
+    # 对于加速域名 https://bucket.oss-accelerate.aliyuncs.com/path
+    # CanonicalURI应该是 /bucket/path
+    if 'oss-accelerate.aliyuncs.com' in host and '.' in host:
+        # 从host中提取bucket名
+        bucket = host.split('.')[0]
+        canonical_uri = f"/{bucket}{path}" if path else f"/{bucket}/"
+    else:
+        canonical_uri = path or '/'
+
+    return canonical_uri, canonical_querystring
+
+def _oss_v4_authorization(signing_key: bytes, access_key_id: str, method: str, url: str,
+                          headers: dict, date_str: str, canonical_uri: Optional[str] = None,
+                          canonical_query: Optional[str] = None) -> str:
+    """生成OSS v4签名的 authorization 头 - 严格按照curlvode.txt格式
+
+    调用方已知 canonical_uri / canonical_query 时直接传入，跳过URL解析与查询参数排序
+    """
+    # 1. CanonicalURI 与 CanonicalQueryString
+    if canonical_uri is None or canonical_query is None:
+        parsed_uri, parsed_query = _oss_canonical_uri_and_query(url)
+        if canonical_uri is None:
+            canonical_uri = parsed_uri
+        if canonical_query is None:
+            canonical_query = parsed_query
+
+    # 2. CanonicalHeaders - 必须包含所有参与签名的headers并按字母序排列
+    # 注意：需要将headers键名转为小写进行匹配
+    headers_lower = {k.lower(): v for k, v in headers.items()}
+
+    canonical_headers_list = []
+    signed_headers_list = []
+    # 获取所有需要参与签名的headers（按字母序）
+    required_headers = ['content-md5', 'content-type', 'x-oss-content-sha256', 'x-oss-date', 'x-oss-security-token', 'x-oss-user-agent']
+    for header_name in sorted(required_headers):
+        if header_name in headers_lower:
+            canonical_headers_list.append(f"{header_name}:{headers_lower[header_name]}")
+            signed_headers_list.append(header_name)
+
+    canonical_headers = '\n'.join(canonical_headers_list) + '\n'
+    signed_headers = ';'.join(signed_headers_list)
+
+    canonical_request = f"{method}\n{canonical_uri}\n{canonical_query}\n{canonical_headers}\n\nUNSIGNED-PAYLOAD"
+    if DEBUG_STATUS:
+        debug_log(f"Canonical Request: {canonical_request}")
+
+    # 3. String to Sign
+    date_scope = f"{date_str[:8]}/{_OSS_REGION}/{_OSS_SERVICE}/aliyun_v4_request"
+    string_to_sign = f"OSS4-HMAC-SHA256\n{date_str}\n{date_scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+    if DEBUG_STATUS:
+        debug_log(f"String to Sign: {string_to_sign}")
+
+    # 4. 计算签名（signing_key 由 _derive_oss_signing_key 派生）
+    signature = hmac.digest(signing_key, string_to_sign.encode(), 'sha256').hex()
+
+    # 5. Authorization Header - 严格按照curlvode.txt格式
+    return f"OSS4-HMAC-SHA256 Credential={access_key_id}/{date_scope},Signature={signature}"
+
 class QwenClient:
     """
     用于与 chat.qwen.ai API 交互的客户端。
     封装了创建对话、发送消息、接收流式响应及删除对话的逻辑。
     """
+    # 同步历史记录时并发请求会话详情的上限
+    SYNC_CONCURRENCY = 16
+    # OSS分块上传时同时上传的分块数上限（环境变量 OSS_PART_CONCURRENCY 可调）
+    OSS_PART_CONCURRENCY = max(1, int(os.environ.get("OSS_PART_CONCURRENCY", "6")))
+    # 单个分块遇到网络错误、5xx 或 429 时的重试次数，以及指数退避的初始等待秒数
+    OSS_PART_RETRIES = 2
+    OSS_PART_RETRY_BACKOFF = 0.5
+
     def __init__(self, auth_token: str, cookies: str = "", base_url: str = "https://chat.qwen.ai"):
         self.auth_token = auth_token
         self.cookies = cookies
         self.base_url = base_url
-        self.session = requests.Session()
+        # 复用同一个异步HTTP/2客户端，保持连接池与TLS会话，不阻塞事件循环
+        self.session = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=100),
+            timeout=httpx.Timeout(30.0, read=None)  # 流式响应可能持续较长时间，不限制读取超时
+        )
+        # OSS上传使用独立的异步客户端，避免把千问的鉴权头和Cookie发送给OSS
+        self.oss_session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.OSS_PART_CONCURRENCY * 2),
+            timeout=httpx.Timeout(60.0)
+        )
         self.history_manager = ChatHistoryManager(DATABASE_PATH)
         
         # 初始化智能Cookie管理器
@@ -478,11 +958,54 @@ class QwenClient:
         self.user_info = None
         self.models_info = None
         self.user_settings = None
-        self._initialize()
-        # 启动时同步历史记录
-        self.sync_history_from_cloud()
+        # 最近一次写入请求头的token，用于跳过重复的请求头更新
+        self._auth_token_cached = None
+        # 后台执行的会话记录写入任务（保留引用，防止任务在完成前被回收）
+        self._background_tasks = set()
+        # 尚未完成的会话记录写入，以回复内容摘要为键（与 find_matching_session 的查找键一致）
+        self._pending_session_writes = {}
+
+    @property
+    def user_info(self):
+        return self._user_info
+
+    @user_info.setter
+    def user_info(self, value):
+        self._user_info = value
+        # 用户信息变化时同步更新用户ID，构造文件信息时直接读取
+        self.user_id = value.get('id', 'unknown') if value else 'unknown'
+
+    @property
+    def models_info(self):
+        return self._models_info
+
+    @models_info.setter
+    def models_info(self, value):
+        self._models_info = value
+        # 模型列表变化时重建 名称 -> Qwen模型ID 的解析表：
+        # 可用的 Qwen 模型ID 映射到自身，MODEL_MAP 中目标可用的映射优先
+        resolved = {model_id: model_id for model_id in (value or {})}
+        resolved.update({k: v for k, v in MODEL_MAP.items() if v in resolved})
+        self._resolved_models = resolved
+        # 模型列表变化时作废 /v1/models 的缓存响应体
+        self._models_response = None
+
+    def models_response_body(self) -> bytes:
+        """返回 /v1/models 的 JSON 响应体，按当前模型列表缓存，模型列表更新后首次调用时重建"""
+        if self._models_response is None:
+            # 从已获取的模型信息构造 OpenAI 格式列表
+            openai_models = [
+                ModelInfo(
+                    id=model_info['info']['id'],
+                    created=model_info['info']['created_at'],
+                    owned_by=model_info['owned_by']
+                )
+                for model_info in self._models_info.values()
+            ]
+            self._models_response = orjson.dumps(ModelsResponse(data=openai_models).model_dump())
+        return self._models_response
 
-    def _initialize(self):
+    async def _initialize(self):
         """初始化客户端，获取用户信息、模型列表和用户设置"""
         self._update_auth_header()
         
@@ -497,7 +1020,7 @@ class QwenClient:
             
         try:
             # 获取用户信息
-            user_info_res = self.session.get(f"{self.base_url}/api/v1/auths/")
+            user_info_res = await self.session.get(f"{self.base_url}/api/v1/auths/")
             
             user_info_res.raise_for_status()
             
@@ -512,18 +1035,18 @@ class QwenClient:
             self.user_info = user_info_res.json()
 
             # 获取模型列表
-            models_res = self.session.get(f"{self.base_url}/api/models")
+            models_res = await self.session.get(f"{self.base_url}/api/models")
             models_res.raise_for_status()
             self.models_info = {model['id']: model for model in models_res.json()['data']}
 
             # 获取用户设置
-            settings_res = self.session.get(f"{self.base_url}/api/v2/users/user/settings")
+            settings_res = await self.session.get(f"{self.base_url}/api/v2/users/user/settings")
             settings_res.raise_for_status()
             self.user_settings = settings_res.json()['data']
             
             logger.debug("客户端初始化成功")
 
-        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        except (httpx.HTTPError, ValueError, KeyError) as e:
             logger.debug(f"客户端初始化失败: {e}")
             logger.debug("请检查 QWEN_AUTH_TOKEN 是否正确设置在 .env 文件中")
             # 设置默认值以避免后续错误
@@ -533,9 +1056,21 @@ class QwenClient:
             # 不抛出异常，允许程序继续运行
 
     def _update_auth_header(self):
-        """更新会话中的认证头"""
-        self.session.headers.update({"authorization": f"Bearer {self.auth_token}"})
+        """更新会话中的认证头（仅在token变化时重新设置）"""
+        if self._auth_token_cached == self.auth_token:
+            return
+        self.session.headers["authorization"] = f"Bearer {self.auth_token}"
+        self._auth_token_cached = self.auth_token
         
+    async def close(self):
+        """关闭HTTP客户端和数据库连接池"""
+        # 先等待尚未完成的会话记录写入，再关闭连接池
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        await self.session.aclose()
+        await self.oss_session.aclose()
+        await self.history_manager.close()
+
     def _check_cookie_health(self, force_check=False):
         """检查Cookie健康状态 - 简化版本"""
         current_time = time.time()
@@ -557,149 +1092,148 @@ class QwenClient:
         if not files:
             return original_prompt
 
-        # 分析文件类型
-        file_types = []
-        file_classes = []
+        # 原始提示已经足够详细时保持原样，无需分析文件类型
+        if original_prompt and len(original_prompt.strip()) >= 10:
+            return original_prompt
 
+        # 单次遍历文件列表，用位标记记录出现过的文件类型
+        flags = 0
         for file_info in files:
             file_class = file_info.get('file_class', 'document')
-            file_types.append(file_info.get('file_type', 'application/octet-stream'))
-            file_classes.append(file_class)
-
-        # 统计文件类型
-        has_images = any(fc == 'vision' for fc in file_classes)
-        has_videos = any(fc == 'video' for fc in file_classes)
-        has_documents = any(fc == 'document' for fc in file_classes)
-        has_pdf = any('pdf' in ft for ft in file_types)
-        has_office = any(any(office in ft for office in ['word', 'excel', 'powerpoint', 'spreadsheet', 'presentation']) for ft in file_types)
-        has_text = any(ft.startswith('text/') for ft in file_types)
-        has_json = any('json' in ft for ft in file_types)
-        has_xml = any('xml' in ft for ft in file_types)
+            file_type = file_info.get('file_type', 'application/octet-stream')
+            if file_class == 'vision':
+                flags |= _HAS_IMAGE
+            elif file_class == 'video':
+                flags |= _HAS_VIDEO
+            if 'pdf' in file_type:
+                flags |= _HAS_PDF
+            if any(office in file_type for office in _OFFICE_TOKENS):
+                flags |= _HAS_OFFICE
+            if file_type.startswith('text/'):
+                flags |= _HAS_TEXT
+            if 'json' in file_type:
+                flags |= _HAS_JSON
+            if 'xml' in file_type:
+                flags |= _HAS_XML
 
         # 生成增强提示语
-        enhanced_prompts = []
-
-        if has_images:
-            enhanced_prompts.append("识别图片中的内容和信息")
-
-        if has_videos:
-            enhanced_prompts.append("分析视频内容、场景信息和关键画面")
-
-        if has_pdf:
-            enhanced_prompts.append("解析PDF文档中的文本内容和结构信息")
-
-        if has_office:
-            enhanced_prompts.append("分析Office文档(Word/Excel/PowerPoint)的内容和数据")
-
-        if has_text:
-            enhanced_prompts.append("处理文本文件的内容")
-
-        if has_json:
-            enhanced_prompts.append("解析JSON数据结构和内容")
-
-        if has_xml:
-            enhanced_prompts.append("解析XML文档结构和数据")
-
-        # 如果原始提示为空或太简单，使用智能生成的提示
-        if not original_prompt or len(original_prompt.strip()) < 10:
-            if enhanced_prompts:
-                return f"请帮我{', '.join(enhanced_prompts)}，并提供详细分析。"
-            else:
-                return "请分析这些文件的内容并提供详细信息。"
-
-        # 如果原始提示已经足够详细，保持原样
-        return original_prompt
+        enhanced_prompts = [prompt for flag, prompt in _SMART_PROMPTS if flags & flag]
+
+        # 原始提示为空或太简单，使用智能生成的提示
+        if enhanced_prompts:
+            return f"请帮我{', '.join(enhanced_prompts)}，并提供详细分析。"
+        return "请分析这些文件的内容并提供详细信息。"
+
+    async def _fetch_history_page(self, page: int) -> list:
+        """获取一页云端历史会话列表，没有更多数据时返回空列表"""
+        list_url = f"{self.base_url}/api/v2/chats/?page={page}"
+        response = await self.session.get(list_url)
+        response.raise_for_status()
+        data = response.json()
+        
+        if not data.get('success') or not data.get('data'):
+            return []
+        return data['data']
+
+    async def _fetch_session_row(self, session: dict, semaphore: asyncio.Semaphore):
+        """获取单个会话的详细信息，返回待写入数据库的行；失败时返回 None"""
+        chat_id = session['id']
+        async with semaphore:
+            try:
+                detail_url = f"{self.base_url}/api/v2/chats/{chat_id}"
+                detail_response = await self.session.get(detail_url)
+                detail_response.raise_for_status()
+                detail_data = detail_response.json()
+            except Exception as e:
+                debug_log(f"获取会话 {chat_id} 详细信息失败: {e}")
+                return None
+        
+        try:
+            if not detail_data.get('success'):
+                return None
+            
+            chat_detail = detail_data['data']
+            messages = chat_detail.get('chat', {}).get('messages', [])
+            
+            # 提取最新的AI回复内容
+            last_assistant_content = ""
+            msg = last_message_by_role(messages, 'assistant')
+            if msg is not None:
+                # 从content_list中提取内容
+                content_list = msg.get('content_list', [])
+                if content_list:
+                    last_assistant_content = content_list[-1].get('content', '')
+                else:
+                    last_assistant_content = msg.get('content', '')
+            
+            current_response_id = chat_detail.get('currentId', '')
+            
+            return (
+                chat_id,
+                session.get('title', ''),
+                session.get('created_at', 0),
+                session.get('updated_at', 0),
+                session.get('chat_type', ''),
+                current_response_id,
+                last_assistant_content
+            )
+        except Exception as e:
+            debug_log(f"获取会话 {chat_id} 详细信息失败: {e}")
+            return None
 
-    def sync_history_from_cloud(self):
+    async def sync_history_from_cloud(self):
         """从云端同步历史记录到本地数据库"""
         debug_log("开始从云端同步历史记录")
         self._update_auth_header()
         
+        page_task = None
         try:
             # 清空本地记录
-            self.history_manager.clear_all_sessions()
+            await self.history_manager.clear_all_sessions()
             
+            # 限制同时进行的会话详情请求数
+            semaphore = asyncio.Semaphore(self.SYNC_CONCURRENCY)
             page = 1
+            page_task = asyncio.create_task(self._fetch_history_page(page))
             while True:
                 # 获取历史会话列表
-                list_url = f"{self.base_url}/api/v2/chats/?page={page}"
-                response = self.session.get(list_url)
-                response.raise_for_status()
-                data = response.json()
-                
-                if not data.get('success') or not data.get('data'):
-                    break
-                
-                sessions = data['data']
-                debug_log(f"第 {page} 页获取到 {len(sessions)} 个会话")
-                
+                sessions = await page_task
                 if not sessions:
                     break
                 
-                # 获取每个会话的详细信息
-                for session in sessions:
-                    chat_id = session['id']
-                    try:
-                        detail_url = f"{self.base_url}/api/v2/chats/{chat_id}"
-                        detail_response = self.session.get(detail_url)
-                        detail_response.raise_for_status()
-                        detail_data = detail_response.json()
-                        
-                        if not detail_data.get('success'):
-                            continue
-                        
-                        chat_detail = detail_data['data']
-                        messages = chat_detail.get('chat', {}).get('messages', [])
-                        
-                        # 提取最新的AI回复内容
-                        last_assistant_content = ""
-                        for msg in reversed(messages):
-                            if msg.get('role') == 'assistant':
-                                # 从content_list中提取内容
-                                content_list = msg.get('content_list', [])
-                                if content_list:
-                                    last_assistant_content = content_list[-1].get('content', '')
-                                else:
-                                    last_assistant_content = msg.get('content', '')
-                                break
-                        
-                        # 保存到本地数据库
-                        current_response_id = chat_detail.get('currentId', '')
-                        
-                        self.history_manager.update_session(
-                            chat_id=chat_id,
-                            title=session.get('title', ''),
-                            created_at=session.get('created_at', 0),
-                            updated_at=session.get('updated_at', 0),
-                            chat_type=session.get('chat_type', ''),
-                            current_response_id=current_response_id,
-                            last_assistant_content=last_assistant_content
-                        )
-                        
-                    except Exception as e:
-                        debug_log(f"获取会话 {chat_id} 详细信息失败: {e}")
-                        continue
+                if DEBUG_STATUS:
+                    debug_log(f"第 {page} 页获取到 {len(sessions)} 个会话")
                 
+                # 拉取本页会话详情的同时预取下一页列表
                 page += 1
+                page_task = asyncio.create_task(self._fetch_history_page(page))
+                
+                # 并发获取每个会话的详细信息，整页数据在一个事务中写入
+                rows = await asyncio.gather(*(self._fetch_session_row(session, semaphore) for session in sessions))
+                await self.history_manager.bulk_update_sessions([row for row in rows if row])
                 
             debug_log("历史记录同步完成")
             
         except Exception as e:
             debug_log(f"同步历史记录失败: {e}")
+        finally:
+            if page_task:
+                if not page_task.done():
+                    page_task.cancel()
+                elif not page_task.cancelled():
+                    # 预取的下一页可能已经失败，读取其异常，避免 "Task exception was never retrieved"
+                    page_task.exception()
 
     def _get_qwen_model_id(self, openai_model: str) -> str:
         """将 OpenAI 模型名称映射到 Qwen 模型 ID"""
-        # 如果直接匹配到 key，则使用映射值；否则尝试看模型 ID 是否直接存在于 Qwen 模型列表中；最后回退到默认模型
-        mapped_id = MODEL_MAP.get(openai_model)
-        if mapped_id and mapped_id in self.models_info:
-            return mapped_id
-        elif openai_model in self.models_info:
-            return openai_model # OpenAI 模型名恰好与 Qwen ID 相同
-        else:
+        # 解析表中已合并 MODEL_MAP 映射和 Qwen 模型ID 本身；都匹配不到时回退到默认模型
+        qwen_model_id = self._resolved_models.get(openai_model)
+        if qwen_model_id is None:
             logger.debug(f"模型 '{openai_model}' 未找到或未映射，使用默认模型 'qwen3-235b-a22b'")
             return "qwen3-235b-a22b" # 最可靠的回退选项
+        return qwen_model_id
 
-    def create_chat(self, model_id: str, title: str = "新对话") -> str:
+    async def create_chat(self, model_id: str, title: str = "新对话") -> str:
         """创建一个新的对话"""
         self._update_auth_header() # 确保 token 是最新的
         url = f"{self.base_url}/api/v2/chats/new"
@@ -711,49 +1245,47 @@ class QwenClient:
             "timestamp": int(time.time() * 1000)
         }
         try:
-            response = self.session.post(url, json=payload)
+            response = await self.session.post(url, json=payload)
             response.raise_for_status()
             chat_id = response.json()['data']['id']
-            debug_log(f"成功创建对话: {chat_id}")
+            if DEBUG_STATUS:
+                debug_log(f"成功创建对话: {chat_id}")
             return chat_id
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             debug_log(f"创建对话失败: {e}")
             raise
 
-    def delete_chat(self, chat_id: str):
+    async def delete_chat(self, chat_id: str):
         """删除一个对话"""
         self._update_auth_header() # 确保 token 是最新的
         url = f"{self.base_url}/api/v2/chats/{chat_id}"
         
         try:
-            response = self.session.delete(url)
+            response = await self.session.delete(url)
             response.raise_for_status()
             res_data = response.json()
             if res_data.get('success', False):
-                debug_log(f"成功删除对话: {chat_id}")
+                if DEBUG_STATUS:
+                    debug_log(f"成功删除对话: {chat_id}")
                 # 同时删除本地记录
-                self.history_manager.delete_session(chat_id)
+                await self.history_manager.delete_session(chat_id)
                 return True
             else:
                 debug_log(f"删除对话 {chat_id} 返回 success=False: {res_data}")
                 return False
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             debug_log(f"删除对话失败 {chat_id}: {e}")
             return False
         except json.JSONDecodeError:
             debug_log(f"删除对话时无法解析 JSON 响应 {chat_id}")
             return False
 
-    def find_matching_session(self, messages: list):
+    async def find_matching_session(self, messages: list):
         """根据消息历史查找匹配的会话"""
         debug_log("开始查找匹配的会话")
         
         # 检查是否有AI回复历史
-        last_assistant_message = None
-        for msg in reversed(messages):
-            if msg.get('role') == 'assistant':
-                last_assistant_message = msg
-                break
+        last_assistant_message = last_message_by_role(messages, 'assistant')
         
         if not last_assistant_message:
             debug_log("请求中没有AI回复历史，将创建新会话")
@@ -766,24 +1298,138 @@ class QwenClient:
         
         debug_log("查找匹配...")
         
+        # 上一轮回复的会话记录可能仍在后台写入（客户端立即发送下一轮时），先等待写入完成；
+        # 使用 asyncio.wait：当前请求被取消时不会连带取消写入任务，写入失败也不在此抛出
+        pending_write = self._pending_session_writes.get(ChatHistoryManager.content_hash(last_content))
+        if pending_write is not None:
+            await asyncio.wait((pending_write,))
+        
         # 查找匹配的会话
-        matched_session = self.history_manager.get_session_by_last_content(last_content)
+        matched_session = await self.history_manager.get_session_by_last_content(last_content)
         
         if matched_session:
-            debug_log(f"找到匹配的会话: {matched_session['chat_id']}")
+            if DEBUG_STATUS:
+                debug_log(f"找到匹配的会话: {matched_session['chat_id']}")
             return matched_session
         else:
             debug_log("未找到匹配的会话，将创建新会话")
             return None
 
-    def update_session_after_chat(self, chat_id: str, title: str, messages: list, 
-                                  current_response_id: str, assistant_content: str):
-        """聊天结束后更新会话记录"""
-        debug_log(f"更新会话记录: {chat_id}")
+    @staticmethod
+    def _build_feature_config(enable_thinking: bool, thinking_budget: Optional[int]) -> dict:
+        """构建 feature_config；未指定 thinking_budget 时直接返回共享的固定配置"""
+        if not enable_thinking:
+            return _FEATURE_CONFIG_THINKING_OFF
+        if thinking_budget is None:
+            return _FEATURE_CONFIG_THINKING_ON
+        return {**_FEATURE_CONFIG_THINKING_ON, "thinking_budget": thinking_budget}
+
+    @staticmethod
+    def _build_chat_payload(chat_id: str, qwen_model_id: str, parent_id: Optional[str], content: str,
+                            files: list, feature_config: dict, timestamp_ms: int) -> dict:
+        """在固定模板的基础上填入本次请求的动态字段，构建 /api/v2/chat/completions 的请求负载"""
+        fid, child_id = fast_uuid4_pair()
+        return {
+            **_CHAT_PAYLOAD_TEMPLATE,
+            "chat_id": chat_id,
+            "model": qwen_model_id,
+            "parent_id": parent_id,
+            "messages": [{
+                **_CHAT_MESSAGE_TEMPLATE,
+                "fid": fid,
+                "parentId": parent_id,
+                "childrenIds": [child_id],
+                "content": content,
+                "files": files,
+                "timestamp": timestamp_ms,
+                "models": [qwen_model_id],
+                "feature_config": feature_config,
+                "parent_id": parent_id
+            }],
+            "timestamp": timestamp_ms
+        }
+
+    @staticmethod
+    async def _iter_sse_lines(response: httpx.Response):
+        """按字节读取上游响应并逐行产出（bytes，不做unicode解码）
+
+        未完成的行保留在 bytearray 中原地追加，只从上次扫描的位置继续查找换行，
+        避免超长行（如多模态响应中的base64）跨多个块时被反复拼接和重新扫描。
+        """
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            scan_from = len(buffer)
+            buffer += chunk
+            start = 0
+            while True:
+                i = buffer.find(b"\n", scan_from)
+                if i < 0:
+                    break
+                yield bytes(buffer[start:i])
+                start = scan_from = i + 1
+            if start:
+                del buffer[:start]
+        if buffer:
+            yield bytes(buffer)
+
+    @classmethod
+    async def _iter_sse_data(cls, response: httpx.Response):
+        """解析上游 SSE 响应中的 data 事件
+
+        逐条产出 orjson 解析后的 dict；遇到 [DONE] 结束标记时产出 None 并停止，
+        无法解析的行直接跳过。
+        """
+        async for line in cls._iter_sse_lines(response):
+            # 检查标准的 SSE 前缀
+            if not line.startswith(_SSE_DATA_PREFIX):
+                continue
+            data_bytes = line[6:].strip()  # 移除 'data: ' 及行尾的 \r
+            if data_bytes == _SSE_DONE_MARKER:
+                yield None
+                return
+            # 空行、心跳等不可能是JSON对象的内容直接跳过，不进入解析器
+            if data_bytes[:1] != b"{":
+                continue
+            try:
+                data = orjson.loads(data_bytes)
+            except orjson.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                yield data
+
+    def schedule_session_update(self, **kwargs):
+        """在后台任务中执行 update_session_after_chat，不阻塞响应的返回
+
+        写入完成前按回复内容摘要登记该任务，find_matching_session 查找同一回复时会先等待写入。
+        登记只在当前进程内有效：多进程（--workers）部署时下一轮若由其他工作进程处理，
+        仍可能在写入提交前查找而匹配不到会话。
+        """
+        task = asyncio.create_task(self.update_session_after_chat(**kwargs))
+        key = ChatHistoryManager.content_hash(kwargs["assistant_content"])
+        self._pending_session_writes[key] = task
+        self._background_tasks.add(task)
+        task.add_done_callback(lambda t: self._on_session_update_done(t, key))
+
+    def _on_session_update_done(self, task: asyncio.Task, key: str):
+        self._background_tasks.discard(task)
+        if self._pending_session_writes.get(key) is task:
+            del self._pending_session_writes[key]
+        if not task.cancelled() and task.exception() is not None:
+            # 写入在请求结束后进行，失败不会再反映到响应上；不依赖 DEBUG_STATUS，始终记录
+            logger.warning(f"更新会话记录失败: {task.exception()}", exc_info=task.exception())
+
+    async def update_session_after_chat(self, chat_id: str, title: str,
+                                        current_response_id: str, assistant_content: str):
+        """聊天结束后更新会话记录
+
+        会话匹配只依赖最后一条assistant回复和response_id，无需传入完整消息历史。
+        """
+        if DEBUG_STATUS:
+            debug_log(f"更新会话记录: {chat_id}")
         
         current_time = int(time.time())
         
-        self.history_manager.update_session(
+        await self.history_manager.update_session(
             chat_id=chat_id,
             title=title,
             created_at=current_time,
@@ -836,10 +1482,14 @@ class QwenClient:
         # 映射模型
         qwen_model_id = self._get_qwen_model_id(model)
 
-        debug_log(f"收到聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
+        if DEBUG_STATUS:
+            debug_log(f"收到聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
 
         # 查找匹配的现有会话
-        matched_session = self.find_matching_session(messages)
+        matched_session = await self.find_matching_session(messages)
+        # 本次请求的时间戳只取一次，供消息负载、会话标题和响应块共用
+        timestamp_ms = int(time.time() * 1000)
+        created = timestamp_ms // 1000
         
         chat_id = None
         parent_id = None
@@ -851,12 +1501,12 @@ class QwenClient:
             parent_id = matched_session['current_response_id']
             
             # 只取最新的用户消息
-            for msg in reversed(messages):
-                if msg.get('role') == 'user':
-                    user_input = msg.get('content', '')
-                    break
+            last_user_message = last_message_by_role(messages, 'user')
+            if last_user_message:
+                user_input = last_user_message.get('content', '')
             
-            debug_log(f"使用现有会话 {chat_id}，parent_id: {parent_id}")
+            if DEBUG_STATUS:
+                debug_log(f"使用现有会话 {chat_id}，parent_id: {parent_id}")
             
         else:
             # 创建新会话，拼接所有消息
@@ -865,182 +1515,63 @@ class QwenClient:
                 formatted_history = "system:\n\n" + formatted_history
             user_input = formatted_history
             
-            chat_id = self.create_chat(qwen_model_id, title=f"OpenAI_API_对话_{int(time.time())}")
+            chat_id = await self.create_chat(qwen_model_id, title=f"OpenAI_API_对话_{created}")
             parent_id = None
             
-            debug_log(f"创建新会话 {chat_id}")
+            if DEBUG_STATUS:
+                debug_log(f"创建新会话 {chat_id}")
 
         try:
-            # 准备请求负载
-            timestamp_ms = int(time.time() * 1000)
-            
-            # 构建 feature_config
-            feature_config = {
-                "output_schema": "phase"
-            }
-            if enable_thinking:
-                feature_config["thinking_enabled"] = True
-                # 如果提供了 thinking_budget 则使用，否则尝试从用户设置获取
-                if thinking_budget is not None:
-                    feature_config["thinking_budget"] = thinking_budget
-                else:
-                    # 尝试从用户设置中获取默认的 thinking_budget
-                    default_budget = self.user_settings.get('model_config', {}).get(qwen_model_id, {}).get('thinking_budget')
-                    if default_budget:
-                        feature_config["thinking_budget"] = default_budget
-            else:
-                feature_config["thinking_enabled"] = False
-
-            payload = {
-                "stream": True, # 始终使用流式以获取实时数据
-                "incremental_output": True,
-                "chat_id": chat_id,
-                "chat_mode": "normal",
-                "model": qwen_model_id,
-                "parent_id": parent_id,
-                "messages": [{
-                    "fid": str(uuid.uuid4()),
-                    "parentId": parent_id,
-                    "childrenIds": [str(uuid.uuid4())],
-                    "role": "user",
-                    "content": user_input,
-                    "user_action": "chat",
-                    "files": [],
-                    "timestamp": timestamp_ms,
-                    "models": [qwen_model_id],
-                    "chat_type": "t2t",
-                    "feature_config": feature_config,
-                    "extra": {"meta": {"subChatType": "t2t"}},
-                    "sub_chat_type": "t2t",
-                    "parent_id": parent_id
-                }],
-                "timestamp": timestamp_ms
-            }
+            # 构建 feature_config：如果提供了 thinking_budget 则使用，否则尝试从用户设置获取默认值
+            if enable_thinking and thinking_budget is None:
+                thinking_budget = self.user_settings.get('model_config', {}).get(qwen_model_id, {}).get('thinking_budget') or None
+            feature_config = self._build_feature_config(enable_thinking, thinking_budget)
 
-            # 添加必要的头
-            headers = {
-                "x-accel-buffering": "no" # 对于流式响应很重要
-            }
+            payload = self._build_chat_payload(chat_id, qwen_model_id, parent_id, user_input, [],
+                                               feature_config, timestamp_ms)
+            headers = _CHAT_STREAM_HEADERS
 
             url = f"{self.base_url}/api/v2/chat/completions?chat_id={chat_id}"
             
             if stream:
                 # 流式请求
                 async def generate():
+                    state = StreamAccumulator(chat_id, model, created)
+                    current_response_id = None  # 当前回复ID
                     try:
                         # 使用流式请求，并确保会话能正确处理连接
-                        with self.session.post(url, json=payload, headers=headers, stream=True) as r:
+                        async with self.session.stream("POST", url, content=orjson.dumps(payload), headers=headers) as r:
                             r.raise_for_status()
-                            finish_reason = "stop"
-                            reasoning_text = ""  # 用于累积 thinking 阶段的内容
-                            assistant_content = ""  # 用于累积assistant回复内容
-                            has_sent_content = False # 标记是否已经开始发送 answer 内容
-                            current_response_id = None  # 当前回复ID
-
-                            for line in r.iter_lines(decode_unicode=True):
-                                # 检查标准的 SSE 前缀
-                                if line.startswith("data: "):
-                                    data_str = line[6:]  # 移除 'data: '
-                                    if data_str.strip() == "[DONE]":
-                                        # 发送最终的 done 消息块，包含 finish_reason
-                                        final_chunk = {
-                                            "id": f"chatcmpl-{chat_id[:10]}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": model,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {}, 
-                                                "finish_reason": finish_reason
-                                            }]
-                                        }
-                                        yield f"data: {json.dumps(final_chunk)}\n\n"
-                                        yield "data: [DONE]\n\n"
-                                        break
-                                    try:
-                                        data = json.loads(data_str)
-                                        
-                                        # 提取response_id
-                                        if "response.created" in data:
-                                            current_response_id = data["response.created"].get("response_id")
-                                            debug_log(f"获取到response_id: {current_response_id}")
-                                        
-                                        # 处理 choices 数据
-                                        if "choices" in data and len(data["choices"]) > 0:
-                                            choice = data["choices"][0]
-                                            delta = choice.get("delta", {})
-                                            
-                                            # --- 重构逻辑：清晰区分 think 和 answer 阶段 ---
-                                            phase = delta.get("phase")
-                                            status = delta.get("status")
-                                            content = delta.get("content", "")
-
-                                            # 1. 处理 "think" 阶段
-                                            if phase == "think":
-                                                if status != "finished":
-                                                    reasoning_text += content
-                                                # 注意：think 阶段的内容不直接发送，只累积
-
-                                            # 2. 处理 "answer" 阶段 或 无明确 phase 的内容 (兼容性)
-                                            elif phase == "answer" or (phase is None and content):
-                                                # 一旦进入 answer 阶段或有内容，标记为已开始
-                                                has_sent_content = True 
-                                                assistant_content += content  # 累积assistant回复
-                                                
-                                                # 构造包含 content 的流式块
-                                                openai_chunk = {
-                                                    "id": f"chatcmpl-{chat_id[:10]}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": model,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": content},
-                                                        "finish_reason": None # answer 阶段进行中不设 finish_reason
-                                                    }]
-                                                }
-                                                # 如果累积了 reasoning_text，则在第一个 answer 块中附带
-                                                if reasoning_text:
-                                                     openai_chunk["choices"][0]["delta"]["reasoning_content"] = reasoning_text
-                                                     reasoning_text = "" # 发送后清空
-
-                                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-
-                                            # 3. 处理结束信号 (通常在 answer 阶段的最后一个块)
-                                            if status == "finished":
-                                                finish_reason = delta.get("finish_reason", "stop")
-
-                                    except json.JSONDecodeError:
-                                        continue
-                    except requests.exceptions.RequestException as e:
+
+                            async for data in self._iter_sse_data(r):
+                                if data is None:  # [DONE] 结束标记
+                                    # 发送最终的 done 消息块，包含 finish_reason
+                                    yield sse_event(state.final_chunk())
+                                    yield SSE_DONE
+                                    break
+
+                                # 提取response_id
+                                if "response.created" in data:
+                                    current_response_id = data["response.created"].get("response_id")
+                                    if DEBUG_STATUS:
+                                        debug_log(f"获取到response_id: {current_response_id}")
+
+                                # 处理 choices 数据，按 phase 分派；answer 阶段返回需要转发的流式块
+                                if "choices" in data and len(data["choices"]) > 0:
+                                    openai_chunk = state.feed(data["choices"][0].get("delta", {}))
+                                    if openai_chunk:
+                                        yield sse_event(openai_chunk)
+                    except httpx.HTTPError as e:
                         debug_log(f"流式请求失败: {e}")
                         # 发送一个错误块
-                        error_chunk = {
-                            "id": f"chatcmpl-error",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": f"Error during streaming: {str(e)}"},
-                                "finish_reason": "error"
-                            }]
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
+                        yield sse_event(state.error_chunk(f"Error during streaming: {str(e)}"))
                     finally:
                         # 聊天结束后更新会话记录
+                        assistant_content = state.assistant_content()
                         if assistant_content and current_response_id:
-                            # 构建完整的消息历史
-                            updated_messages = messages.copy()
-                            updated_messages.append({
-                                "role": "assistant",
-                                "content": assistant_content
-                            })
-                            
-                            self.update_session_after_chat(
+                            self.schedule_session_update(
                                 chat_id=chat_id,
-                                title=f"OpenAI_API_对话_{int(time.time())}",
-                                messages=updated_messages,
+                                title=f"OpenAI_API_对话_{created}",
                                 current_response_id=current_response_id,
                                 assistant_content=assistant_content
                             )
@@ -1049,104 +1580,82 @@ class QwenClient:
 
             else:
                 # 非流式请求: 聚合流式响应
-                response_text = ""  # 用于聚合最终回复
-                reasoning_text = "" # 用于聚合 thinking 阶段的内容
+                response_parts = []  # 用于聚合最终回复
+                reasoning_parts = [] # 用于聚合 thinking 阶段的内容
                 finish_reason = "stop"
                 usage_data = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
                 current_response_id = None
                 
-                try:
-                    with self.session.post(url, json=payload, headers=headers, stream=True) as r:
-                        r.raise_for_status()
-                        for line in r.iter_lines(decode_unicode=True):
-                            # 检查完整的 SSE 前缀
-                            if line.startswith("data: "): 
-                                data_str = line[6:] # 移除 'data: '
-                                if data_str.strip() == "[DONE]":
-                                    break
-                                try:
-                                    data = json.loads(data_str)
-                                    
-                                    # 提取response_id
-                                    if "response.created" in data:
-                                        current_response_id = data["response.created"].get("response_id")
-                                    
-                                    # 处理 choices 数据来构建最终回复
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        delta = data["choices"][0].get("delta", {})
-                                        
-                                        # 累积 "think" 阶段的内容
-                                        if delta.get("phase") == "think":
-                                            if delta.get("status") != "finished":
-                                                reasoning_text += delta.get("content", "")
-                                        
-                                        # 只聚合 "answer" 阶段的内容
-                                        if delta.get("phase") == "answer":
-                                            if delta.get("status") != "finished":
-                                                response_text += delta.get("content", "")
-                                        
-                                        # 收集最后一次的 usage 信息
-                                        if "usage" in data:
-                                            qwen_usage = data["usage"]
-                                            usage_data = {
-                                                "prompt_tokens": qwen_usage.get("input_tokens", 0),
-                                                "completion_tokens": qwen_usage.get("output_tokens", 0),
-                                                "total_tokens": qwen_usage.get("total_tokens", 0),
-                                            }
-                                    
-                                    # 检查是否是结束信号
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        delta = data["choices"][0].get("delta", {})
-                                        if delta.get("status") == "finished":
-                                            finish_reason = delta.get("finish_reason", "stop")
-                                        
-                                except json.JSONDecodeError:
-                                    # 忽略无法解析的行
-                                    continue
-                    
-                    # 聊天结束后更新会话记录
-                    if response_text and current_response_id:
-                        # 构建完整的消息历史
-                        updated_messages = messages.copy()
-                        updated_messages.append({
+                async with self.session.stream("POST", url, content=orjson.dumps(payload), headers=headers) as r:
+                    r.raise_for_status()
+                    async for data in self._iter_sse_data(r):
+                        if data is None:  # [DONE] 结束标记
+                            break
+
+                        # 提取response_id
+                        if "response.created" in data:
+                            current_response_id = data["response.created"].get("response_id")
+
+                        # 处理 choices 数据来构建最终回复
+                        choices = data.get("choices")
+                        if choices:
+                            delta = choices[0].get("delta", {})
+                            if delta.get("status") != "finished":
+                                phase = delta.get("phase")
+                                # 累积 "think" 阶段的内容；只聚合 "answer" 阶段的回复
+                                if phase == "think":
+                                    reasoning_parts.append(delta.get("content", ""))
+                                elif phase == "answer":
+                                    response_parts.append(delta.get("content", ""))
+                            else:
+                                # 结束信号
+                                finish_reason = delta.get("finish_reason", "stop")
+
+                            # 收集最后一次的 usage 信息
+                            if "usage" in data:
+                                qwen_usage = data["usage"]
+                                usage_data = {
+                                    "prompt_tokens": qwen_usage.get("input_tokens", 0),
+                                    "completion_tokens": qwen_usage.get("output_tokens", 0),
+                                    "total_tokens": qwen_usage.get("total_tokens", 0),
+                                }
+                
+                response_text = "".join(response_parts)
+                reasoning_text = "".join(reasoning_parts)
+                
+                # 聊天结束后更新会话记录
+                if response_text and current_response_id:
+                    self.schedule_session_update(
+                        chat_id=chat_id,
+                        title=f"OpenAI_API_对话_{created}",
+                        current_response_id=current_response_id,
+                        assistant_content=response_text
+                    )
+                
+                # 构造非流式的 OpenAI 响应
+                openai_response = {
+                    "id": f"chatcmpl-{chat_id[:10]}",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {
                             "role": "assistant",
                             "content": response_text
-                        })
-                        
-                        self.update_session_after_chat(
-                            chat_id=chat_id,
-                            title=f"OpenAI_API_对话_{int(time.time())}",
-                            messages=updated_messages,
-                            current_response_id=current_response_id,
-                            assistant_content=response_text
-                        )
-                    
-                    # 构造非流式的 OpenAI 响应
-                    openai_response = {
-                        "id": f"chatcmpl-{chat_id[:10]}",
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_text
-                            },
-                            "finish_reason": finish_reason
-                        }],
-                        "usage": usage_data
-                    }
-                    
-                    # 在非流式响应中添加 reasoning_content
-                    if reasoning_text:
-                        openai_response["choices"][0]["message"]["reasoning_content"] = reasoning_text
-                    
-                    return openai_response
-                finally:
-                    pass  # 不再自动删除会话
+                        },
+                        "finish_reason": finish_reason
+                    }],
+                    "usage": usage_data
+                }
+                
+                # 在非流式响应中添加 reasoning_content
+                if reasoning_text:
+                    openai_response["choices"][0]["message"]["reasoning_content"] = reasoning_text
+                
+                return openai_response
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             debug_log(f"聊天补全失败: {e}")
             # 返回 OpenAI 格式的错误
             raise HTTPException(
@@ -1173,8 +1682,9 @@ class QwenClient:
         }
         
         try:
-            debug_log(f"请求STS Token: {payload}")
-            response = self.session.post(url, json=payload)
+            if DEBUG_STATUS:
+                debug_log(f"请求STS Token: {payload}")
+            response = await self.session.post(url, json=payload)
             response.raise_for_status()
             
             # 检查响应内容类型
@@ -1184,7 +1694,8 @@ class QwenClient:
                 raise ValueError("API返回非JSON响应")
             
             result = response.json()
-            debug_log(f"STS Token响应: {result}")
+            if DEBUG_STATUS:
+                debug_log(f"STS Token响应: {result}")
             
             # 检查响应是否成功
             if not result.get("success", False):
@@ -1192,9 +1703,10 @@ class QwenClient:
                 debug_log(f"STS Token获取失败: {error_msg}")
                 raise ValueError(f"API返回错误: {error_msg}")
             
-            debug_log(f"获取STS Token成功: {filename}")
+            if DEBUG_STATUS:
+                debug_log(f"获取STS Token成功: {filename}")
             return result
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             debug_log(f"获取STS Token网络错误: {e}")
             if hasattr(e, 'response') and e.response:
                 debug_log(f"错误响应状态码: {e.response.status_code}")
@@ -1224,43 +1736,76 @@ class QwenClient:
                 }
             )
 
-    async def multimodal_chat_completions(self, multimodal_request: dict):
+    def prepare_multimodal_chat(self, model: str) -> Optional[asyncio.Task]:
+        """提前在后台创建新的多模态会话，供一体化上传接口与OSS上传并发进行
+
+        token无效时返回 None，由 multimodal_chat_completions 返回鉴权错误。
+        """
+        if not self.user_info or not self.models_info:
+            return None
+        qwen_model_id = self._get_qwen_model_id(model)
+        return asyncio.create_task(self.create_chat(qwen_model_id, title=f"多模态对话_{int(time.time())}"))
+
+    def discard_prepared_chat(self, chat_task: asyncio.Task):
+        """放弃预先创建的会话：等创建完成后在后台删除，避免在千问账号下留下空会话"""
+        def _cleanup(task: asyncio.Task):
+            if task.cancelled() or task.exception() is not None:
+                return
+            delete_task = asyncio.create_task(self.delete_chat(task.result()))
+            self._background_tasks.add(delete_task)
+            delete_task.add_done_callback(self._background_tasks.discard)
+
+        chat_task.add_done_callback(_cleanup)
+
+    async def multimodal_chat_completions(self, multimodal_request: dict, new_chat: Optional[asyncio.Task] = None):
         """
         执行多模态聊天补全，完全按照 chaturl2.txt 的格式实现
+
+        new_chat 为 prepare_multimodal_chat 提前创建会话的任务；需要新会话时直接使用它的结果
         """
-        # 检查Cookie健康状态
-        self._check_cookie_health()
+        # new_chat 由本方法负责：在使用或放弃它之前出错时，在后台删除预先创建的会话
+        try:
+            # 检查Cookie健康状态
+            self._check_cookie_health()
 
-        # 检查token是否有效
-        if not self.user_info or not self.models_info:
-            error_msg = "QWEN_AUTH_TOKEN 无效或未设置，无法处理多模态聊天请求。"
-            raise HTTPException(
-                status_code=401,
-                detail={
-                    "error": {
-                        "message": error_msg,
-                        "type": "authentication_error",
-                        "param": None,
-                        "code": "invalid_api_key"
+            # 检查token是否有效
+            if not self.user_info or not self.models_info:
+                error_msg = "QWEN_AUTH_TOKEN 无效或未设置，无法处理多模态聊天请求。"
+                raise HTTPException(
+                    status_code=401,
+                    detail={
+                        "error": {
+                            "message": error_msg,
+                            "type": "authentication_error",
+                            "param": None,
+                            "code": "invalid_api_key"
+                        }
                     }
-                }
-            )
+                )
 
-        self._update_auth_header()
+            self._update_auth_header()
 
-        # 解析请求参数
-        model = multimodal_request.get("model", "qwen3-vl-plus")
-        messages = multimodal_request.get("messages", [])
-        stream = multimodal_request.get("stream", False)
-        enable_thinking = multimodal_request.get("enable_thinking", False)  # 多模态默认关闭思考
-        thinking_budget = multimodal_request.get("thinking_budget", None)
+            # 解析请求参数
+            model = multimodal_request.get("model", "qwen3-vl-plus")
+            messages = multimodal_request.get("messages", [])
+            stream = multimodal_request.get("stream", False)
+            enable_thinking = multimodal_request.get("enable_thinking", False)  # 多模态默认关闭思考
+            thinking_budget = multimodal_request.get("thinking_budget", None)
 
-        # 映射模型
-        qwen_model_id = self._get_qwen_model_id(model)
-        debug_log(f"收到多模态聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
+            # 映射模型
+            qwen_model_id = self._get_qwen_model_id(model)
+            if DEBUG_STATUS:
+                debug_log(f"收到多模态聊天请求，消息数量: {len(messages)}, 模型: {qwen_model_id}")
 
-        # 查找匹配的现有会话
-        matched_session = self.find_matching_session(messages)
+            # 查找匹配的现有会话
+            matched_session = await self.find_matching_session(messages)
+            # 本次请求的时间戳只取一次，供消息负载、会话标题和响应块共用
+            timestamp_ms = int(time.time() * 1000)
+            created = timestamp_ms // 1000
+        except BaseException:
+            if new_chat is not None:
+                self.discard_prepared_chat(new_chat)
+            raise
 
         chat_id = None
         parent_id = None
@@ -1271,221 +1816,134 @@ class QwenClient:
             # 使用现有会话
             chat_id = matched_session['chat_id']
             parent_id = matched_session['current_response_id']
-            debug_log(f"使用现有会话 {chat_id}，parent_id: {parent_id}")
+            if new_chat is not None:
+                self.discard_prepared_chat(new_chat)
+            if DEBUG_STATUS:
+                debug_log(f"使用现有会话 {chat_id}，parent_id: {parent_id}")
+        elif new_chat is not None:
+            # 使用提前创建的新会话（shield：本请求被取消时会话创建继续完成，随后在后台删除）
+            try:
+                chat_id = await asyncio.shield(new_chat)
+            except asyncio.CancelledError:
+                self.discard_prepared_chat(new_chat)
+                raise
+            parent_id = None
+            if DEBUG_STATUS:
+                debug_log(f"使用提前创建的多模态会话 {chat_id}")
         else:
             # 创建新会话
-            chat_id = self.create_chat(qwen_model_id, title=f"多模态对话_{int(time.time())}")
+            chat_id = await self.create_chat(qwen_model_id, title=f"多模态对话_{created}")
             parent_id = None
-            debug_log(f"创建新的多模态会话 {chat_id}")
+            if DEBUG_STATUS:
+                debug_log(f"创建新的多模态会话 {chat_id}")
 
         # 处理最新的用户消息（支持多模态）
-        for msg in reversed(messages):
-            if msg.get('role') == 'user':
-                # 处理多模态消息内容
-                if isinstance(msg.get('content'), str):
-                    # 纯文本消息
-                    user_content = msg.get('content', '')
-                elif isinstance(msg.get('content'), list):
-                    # 多模态消息
-                    text_parts = []
-                    for content_part in msg.get('content', []):
-                        if content_part.get("type") == "text":
-                            text_parts.append(content_part.get("text", ""))
-                        elif content_part.get("type") in ["image_url", "video_url"]:
-                            # ✅ 优先使用传入的完整文件信息（如果有）
-                            if "file_info" in content_part:
-                                file_info = content_part["file_info"]
-                                files.append(file_info)
+        msg = last_message_by_role(messages, 'user')
+        if msg is not None:
+            # 处理多模态消息内容
+            if isinstance(msg.get('content'), str):
+                # 纯文本消息
+                user_content = msg.get('content', '')
+            elif isinstance(msg.get('content'), list):
+                # 多模态消息
+                # 绝大多数请求只有一个文本段：先以 str 保存，出现第二段时才转为列表
+                text_parts = None
+                for content_part in msg.get('content', []):
+                    if content_part.get("type") == "text":
+                        text = content_part.get("text", "")
+                        if text_parts is None:
+                            text_parts = text
+                        elif isinstance(text_parts, str):
+                            text_parts = [text_parts, text]
+                        else:
+                            text_parts.append(text)
+                    elif content_part.get("type") in ["image_url", "video_url"]:
+                        # ✅ 优先使用传入的完整文件信息（如果有）
+                        if "file_info" in content_part:
+                            file_info = content_part["file_info"]
+                            files.append(file_info)
+                            if DEBUG_STATUS:
                                 debug_log(f"使用完整文件信息: {file_info.get('name', 'unknown')} (大小: {file_info.get('size', 0)} bytes)")
-                            else:
-                                # 降级：从URL解析文件信息（向后兼容）
-                                if content_part.get("type") == "image_url":
-                                    file_url = content_part.get("image_url", {}).get("url", "")
-                                else:  # video_url
-                                    file_url = content_part.get("video_url", {}).get("url", "")
-
-                                if file_url:
-                                    file_info = self.parse_file_info_from_url(file_url)
-                                    if file_info:
-                                        files.append(file_info)
+                        else:
+                            # 降级：从URL解析文件信息（向后兼容）
+                            if content_part.get("type") == "image_url":
+                                file_url = content_part.get("image_url", {}).get("url", "")
+                            else:  # video_url
+                                file_url = content_part.get("video_url", {}).get("url", "")
+
+                            if file_url:
+                                file_info = self.parse_file_info_from_url(file_url)
+                                if file_info:
+                                    files.append(file_info)
+                                    if DEBUG_STATUS:
                                         debug_log(f"从URL解析文件: {file_info.get('name', 'unknown')} (类型: {file_info.get('file_class', 'unknown')})")
-                                    else:
-                                        debug_log(f"无法解析文件URL: {file_url}")
-
-                    user_content = " ".join(text_parts) if text_parts else ""
+                                else:
+                                    debug_log(f"无法解析文件URL: {file_url}")
 
-                    # 智能提示语生成：根据文件类型调整用户内容
-                    if user_content and files:
-                        user_content = self.generate_smart_prompt(user_content, files)
+                if isinstance(text_parts, list):
+                    user_content = " ".join(text_parts)
+                else:
+                    user_content = text_parts or ""
 
-                break
+                # 智能提示语生成：根据文件类型调整用户内容
+                if user_content and files:
+                    user_content = self.generate_smart_prompt(user_content, files)
 
         try:
-            # 构建符合 Qwen API 格式的请求负载
-            timestamp_ms = int(time.time() * 1000)
-
             # 构建 feature_config
-            feature_config = {
-                "output_schema": "phase"
-            }
-            if enable_thinking:
-                feature_config["thinking_enabled"] = True
-                if thinking_budget is not None:
-                    feature_config["thinking_budget"] = thinking_budget
-            else:
-                feature_config["thinking_enabled"] = False
+            feature_config = self._build_feature_config(enable_thinking, thinking_budget)
 
             # 生成必要的ID
-            fid = str(uuid.uuid4())
-            child_id = str(uuid.uuid4())
-
-            # 构建完整的消息对象（完全按照 chaturl2.txt 格式）
-            message_obj = {
-                "fid": fid,
-                "parentId": parent_id,
-                "childrenIds": [child_id],
-                "role": "user",
-                "content": user_content,
-                "user_action": "chat",
-                "files": files,  # 关键：使用真正的文件数组而不是空数组
-                "timestamp": timestamp_ms,
-                "models": [qwen_model_id],
-                "chat_type": "t2t",
-                "feature_config": feature_config,
-                "extra": {"meta": {"subChatType": "t2t"}},
-                "sub_chat_type": "t2t",
-                "parent_id": parent_id
-            }
-
             # 构建完整的请求负载（完全按照 chaturl2.txt 格式）
-            payload = {
-                "stream": True,  # 始终使用流式以获取实时数据
-                "incremental_output": True,  # 关键字段
-                "chat_id": chat_id,
-                "chat_mode": "normal",
-                "model": qwen_model_id,
-                "parent_id": parent_id,
-                "messages": [message_obj],
-                "timestamp": timestamp_ms
-            }
-
-            # 添加必要的头
-            headers = {
-                "x-accel-buffering": "no"  # 对于流式响应很重要
-            }
+            # 关键：files 使用真正的文件数组而不是空数组
+            payload = self._build_chat_payload(chat_id, qwen_model_id, parent_id, user_content, files,
+                                               feature_config, timestamp_ms)
+            headers = _CHAT_STREAM_HEADERS
 
             url = f"{self.base_url}/api/v2/chat/completions?chat_id={chat_id}"
-            debug_log(f"发送多模态请求到: {url}")
-            debug_log(f"请求负载包含 {len(files)} 个文件")
+            if DEBUG_STATUS:
+                debug_log(f"发送多模态请求到: {url}")
+                debug_log(f"请求负载包含 {len(files)} 个文件")
 
             if stream:
                 # 流式请求
                 async def generate():
+                    state = StreamAccumulator(chat_id, model, created)
+                    current_response_id = None  # 当前回复ID
                     try:
-                        with self.session.post(url, json=payload, headers=headers, stream=True) as r:
+                        async with self.session.stream("POST", url, content=orjson.dumps(payload), headers=headers) as r:
                             r.raise_for_status()
-                            finish_reason = "stop"
-                            reasoning_text = ""
-                            assistant_content = ""
-                            has_sent_content = False
-                            current_response_id = None
-
-                            for line in r.iter_lines(decode_unicode=True):
-                                if line.startswith("data: "):
-                                    data_str = line[6:]
-                                    if data_str.strip() == "[DONE]":
-                                        # 发送最终的 done 消息块
-                                        final_chunk = {
-                                            "id": f"chatcmpl-{chat_id[:10]}",
-                                            "object": "chat.completion.chunk",
-                                            "created": int(time.time()),
-                                            "model": model,
-                                            "choices": [{
-                                                "index": 0,
-                                                "delta": {},
-                                                "finish_reason": finish_reason
-                                            }]
-                                        }
-                                        yield f"data: {json.dumps(final_chunk)}\n\n"
-                                        yield "data: [DONE]\n\n"
-                                        break
-
-                                    try:
-                                        data = json.loads(data_str)
-
-                                        # 提取response_id
-                                        if "response.created" in data:
-                                            current_response_id = data["response.created"].get("response_id")
-                                            debug_log(f"获取到response_id: {current_response_id}")
-
-                                        # 处理 choices 数据
-                                        if "choices" in data and len(data["choices"]) > 0:
-                                            choice = data["choices"][0]
-                                            delta = choice.get("delta", {})
-
-                                            phase = delta.get("phase")
-                                            status = delta.get("status")
-                                            content = delta.get("content", "")
-
-                                            # 处理 "think" 阶段
-                                            if phase == "think":
-                                                if status != "finished":
-                                                    reasoning_text += content
-
-                                            # 处理 "answer" 阶段
-                                            elif phase == "answer" or (phase is None and content):
-                                                has_sent_content = True
-                                                assistant_content += content
-
-                                                # 构造流式块
-                                                openai_chunk = {
-                                                    "id": f"chatcmpl-{chat_id[:10]}",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": model,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": content},
-                                                        "finish_reason": None
-                                                    }]
-                                                }
-
-                                                # 在第一个块中附带推理内容
-                                                if reasoning_text:
-                                                    openai_chunk["choices"][0]["delta"]["reasoning_content"] = reasoning_text
-                                                    reasoning_text = ""
-
-                                                yield f"data: {json.dumps(openai_chunk)}\n\n"
-
-                                            # 处理结束信号
-                                            if status == "finished":
-                                                finish_reason = delta.get("finish_reason", "stop")
-
-                                    except json.JSONDecodeError:
-                                        continue
-
-                    except requests.exceptions.RequestException as e:
+
+                            async for data in self._iter_sse_data(r):
+                                if data is None:  # [DONE] 结束标记
+                                    # 发送最终的 done 消息块，包含 finish_reason
+                                    yield sse_event(state.final_chunk())
+                                    yield SSE_DONE
+                                    break
+
+                                # 提取response_id
+                                if "response.created" in data:
+                                    current_response_id = data["response.created"].get("response_id")
+                                    if DEBUG_STATUS:
+                                        debug_log(f"获取到response_id: {current_response_id}")
+
+                                # 处理 choices 数据，按 phase 分派；answer 阶段返回需要转发的流式块
+                                if "choices" in data and len(data["choices"]) > 0:
+                                    openai_chunk = state.feed(data["choices"][0].get("delta", {}))
+                                    if openai_chunk:
+                                        yield sse_event(openai_chunk)
+
+                    except httpx.HTTPError as e:
                         debug_log(f"多模态流式请求失败: {e}")
-                        error_chunk = {
-                            "id": f"chatcmpl-error",
-                            "object": "chat.completion.chunk",
-                            "created": int(time.time()),
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": f"Error during streaming: {str(e)}"},
-                                "finish_reason": "error"
-                            }]
-                        }
-                        yield f"data: {json.dumps(error_chunk)}\n\n"
+                        yield sse_event(state.error_chunk(f"Error during streaming: {str(e)}"))
 
                     finally:
                         # 更新会话记录
+                        assistant_content = state.assistant_content()
                         if assistant_content and current_response_id:
-                            self.update_session_after_chat(
+                            self.schedule_session_update(
                                 chat_id=chat_id,
-                                title=f"多模态对话_{int(time.time())}",
-                                messages=messages + [{"role": "assistant", "content": assistant_content}],
+                                title=f"多模态对话_{created}",
                                 current_response_id=current_response_id,
                                 assistant_content=assistant_content
                             )
@@ -1494,95 +1952,82 @@ class QwenClient:
 
             else:
                 # 非流式请求
-                response_text = ""
-                reasoning_text = ""
+                response_parts = []
+                reasoning_parts = []
                 finish_reason = "stop"
                 usage_data = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
                 current_response_id = None
 
-                try:
-                    with self.session.post(url, json=payload, headers=headers, stream=True) as r:
-                        r.raise_for_status()
-                        for line in r.iter_lines(decode_unicode=True):
-                            if line.startswith("data: "):
-                                data_str = line[6:]
-                                if data_str.strip() == "[DONE]":
-                                    break
-
-                                try:
-                                    data = json.loads(data_str)
-
-                                    # 提取response_id
-                                    if "response.created" in data:
-                                        current_response_id = data["response.created"].get("response_id")
-
-                                    # 处理数据
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        delta = data["choices"][0].get("delta", {})
-
-                                        # 累积推理内容
-                                        if delta.get("phase") == "think":
-                                            if delta.get("status") != "finished":
-                                                reasoning_text += delta.get("content", "")
-
-                                        # 累积答案内容
-                                        if delta.get("phase") == "answer":
-                                            if delta.get("status") != "finished":
-                                                response_text += delta.get("content", "")
-
-                                        # 收集 usage 信息
-                                        if "usage" in data:
-                                            qwen_usage = data["usage"]
-                                            usage_data = {
-                                                "prompt_tokens": qwen_usage.get("input_tokens", 0),
-                                                "completion_tokens": qwen_usage.get("output_tokens", 0),
-                                                "total_tokens": qwen_usage.get("total_tokens", 0),
-                                            }
-
-                                        # 检查结束信号
-                                        if delta.get("status") == "finished":
-                                            finish_reason = delta.get("finish_reason", "stop")
-
-                                except json.JSONDecodeError:
-                                    continue
-
-                    # 更新会话记录
-                    if response_text and current_response_id:
-                        self.update_session_after_chat(
-                            chat_id=chat_id,
-                            title=f"多模态对话_{int(time.time())}",
-                            messages=messages + [{"role": "assistant", "content": response_text}],
-                            current_response_id=current_response_id,
-                            assistant_content=response_text
-                        )
-
-                    # 构造非流式响应
-                    openai_response = {
-                        "id": f"chatcmpl-{chat_id[:10]}",
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_text
-                            },
-                            "finish_reason": finish_reason
-                        }],
-                        "usage": usage_data
-                    }
-
-                    # 添加推理内容
-                    if reasoning_text:
-                        openai_response["choices"][0]["message"]["reasoning_content"] = reasoning_text
+                async with self.session.stream("POST", url, content=orjson.dumps(payload), headers=headers) as r:
+                    r.raise_for_status()
+                    async for data in self._iter_sse_data(r):
+                        if data is None:  # [DONE] 结束标记
+                            break
+
+                        # 提取response_id
+                        if "response.created" in data:
+                            current_response_id = data["response.created"].get("response_id")
+
+                        # 处理数据
+                        choices = data.get("choices")
+                        if choices:
+                            delta = choices[0].get("delta", {})
+                            if delta.get("status") != "finished":
+                                phase = delta.get("phase")
+                                # 累积推理内容与答案内容
+                                if phase == "think":
+                                    reasoning_parts.append(delta.get("content", ""))
+                                elif phase == "answer":
+                                    response_parts.append(delta.get("content", ""))
+                            else:
+                                # 结束信号
+                                finish_reason = delta.get("finish_reason", "stop")
+
+                            # 收集 usage 信息
+                            if "usage" in data:
+                                qwen_usage = data["usage"]
+                                usage_data = {
+                                    "prompt_tokens": qwen_usage.get("input_tokens", 0),
+                                    "completion_tokens": qwen_usage.get("output_tokens", 0),
+                                    "total_tokens": qwen_usage.get("total_tokens", 0),
+                                }
+
+                response_text = "".join(response_parts)
+                reasoning_text = "".join(reasoning_parts)
+
+                # 更新会话记录
+                if response_text and current_response_id:
+                    self.schedule_session_update(
+                        chat_id=chat_id,
+                        title=f"多模态对话_{created}",
+                        current_response_id=current_response_id,
+                        assistant_content=response_text
+                    )
+
+                # 构造非流式响应
+                openai_response = {
+                    "id": f"chatcmpl-{chat_id[:10]}",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": response_text
+                        },
+                        "finish_reason": finish_reason
+                    }],
+                    "usage": usage_data
+                }
 
-                    return openai_response
+                # 添加推理内容
+                if reasoning_text:
+                    openai_response["choices"][0]["message"]["reasoning_content"] = reasoning_text
 
-                finally:
-                    pass
+                return openai_response
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             debug_log(f"多模态聊天补全失败: {e}")
             raise HTTPException(
                 status_code=500,
@@ -1596,11 +2041,51 @@ class QwenClient:
                 }
             )
 
+    def build_file_info(self, file_id: Optional[str], filename: str, size: int, content_type: str,
+                        url: str, file_type: str, show_type: str, file_class: str) -> dict:
+        """构造符合 Qwen API 格式的完整文件信息（file_id 为 None 时生成随机ID）"""
+        # 需要的随机ID一次性生成（一次 os.urandom 调用）
+        if file_id is None:
+            file_id, item_id, upload_task_id = fast_uuid4_triple()
+        else:
+            item_id, upload_task_id = fast_uuid4_pair()
+        now_ms = int(time.time() * 1000)
+        return {
+            "type": file_type,
+            "file": {
+                "created_at": now_ms,
+                "data": {},
+                "filename": filename,
+                "hash": None,
+                "id": file_id,
+                "user_id": self.user_id,
+                "meta": {
+                    "name": filename,
+                    "size": size,
+                    "content_type": content_type
+                },
+                "update_at": now_ms
+            },
+            "id": file_id,
+            "url": url,
+            "name": filename,
+            "collection_name": "",
+            "progress": 0,
+            "status": "uploaded",
+            "greenNet": "success",
+            "size": size,
+            "error": "",
+            "itemId": item_id,
+            "file_type": content_type,
+            "showType": show_type,
+            "file_class": file_class,
+            "uploadTaskId": upload_task_id
+        }
+
     def parse_file_info_from_url(self, file_url: str) -> dict:
         """从文件URL解析文件信息，支持OSS URL和多种文件格式"""
         try:
             import urllib.parse as urlparse
-            from urllib.parse import parse_qs
 
             parsed_url = urlparse.urlparse(file_url)
 
@@ -1611,7 +2096,7 @@ class QwenClient:
 
             # 尝试从路径中提取文件ID和名称
             path_parts = path.split('/')
-            file_id = str(uuid.uuid4())
+            file_id = None
             filename = "uploaded_file.txt"
 
             if len(path_parts) >= 2:
@@ -1623,9 +2108,6 @@ class QwenClient:
                         file_id = parts[0]
                         filename = urlparse.unquote(parts[1])
 
-            # 解析查询参数以获取更多信息
-            query_params = parse_qs(parsed_url.query)
-
             # 使用辅助函数确定文件类型和content type
             file_type = determine_filetype(filename, None)
             content_type = determine_content_type(filename, None)
@@ -1641,73 +2123,53 @@ class QwenClient:
                 show_type = "file"
                 file_class = "document"
 
-            return {
-                "type": file_type,
-                "file": {
-                    "created_at": int(time.time() * 1000),
-                    "data": {},
-                    "filename": filename,
-                    "hash": None,
-                    "id": file_id,
-                    "user_id": self.user_info.get('id', 'unknown') if self.user_info else 'unknown',
-                    "meta": {
-                        "name": filename,
-                        "size": 0,  # 无法从URL获取大小
-                        "content_type": content_type
-                    },
-                    "update_at": int(time.time() * 1000)
-                },
-                "id": file_id,
-                "url": file_url,
-                "name": filename,
-                "collection_name": "",
-                "progress": 0,
-                "status": "uploaded",
-                "greenNet": "success",
-                "size": 0,
-                "error": "",
-                "itemId": str(uuid.uuid4()),
-                "file_type": content_type,
-                "showType": show_type,
-                "file_class": file_class,
-                "uploadTaskId": str(uuid.uuid4())
-            }
+            # 路径中解析不出文件ID时由 build_file_info 生成随机ID
+            return self.build_file_info(
+                file_id=file_id,
+                filename=filename,
+                size=0,  # 无法从URL获取大小
+                content_type=content_type,
+                url=file_url,
+                file_type=file_type,
+                show_type=show_type,
+                file_class=file_class
+            )
 
         except Exception as e:
             debug_log(f"解析文件URL失败: {e}")
-            # 返回基本的文件信息
+            # 返回基本的文件信息（内外层使用同一个文件ID，与正常分支一致）
+            file_id = str(uuid.uuid4())
+            now_ms = int(time.time() * 1000)
             return {
                 "type": "file",
                 "file": {
-                    "created_at": int(time.time() * 1000),
+                    "created_at": now_ms,
                     "data": {},
                     "filename": "file.txt",
                     "hash": None,
-                    "id": str(uuid.uuid4()),
-                    "user_id": self.user_info.get('id', 'unknown') if self.user_info else 'unknown',
+                    "id": file_id,
+                    "user_id": self.user_id,
                     "meta": {
                         "name": "file.txt",
                         "size": 0,
                         "content_type": "text/plain"
                     },
-                    "update_at": int(time.time() * 1000)
+                    "update_at": now_ms
                 },
-                "id": str(uuid.uuid4()),
+                "id": file_id,
                 "url": file_url,
                 "name": "file.txt",
                 "status": "uploaded"
             }
 
-    def upload_with_oss_post_form(self, file_content: bytes, file_path: str, content_type: str, sts_data: dict, filename: str) -> dict:
+    async def upload_with_oss_post_form(self, file_content: bytes, file_path: str, content_type: str, sts_data: dict, filename: str) -> dict:
         """使用OSS POST表单上传（更可靠的方式）"""
         try:
-            debug_log(f"使用OSS POST表单上传: {file_path}")
+            if DEBUG_STATUS:
+                debug_log(f"使用OSS POST表单上传: {file_path}")
             
             import base64
-            import json
             from datetime import datetime, timedelta
-            import hmac
-            import hashlib
             
             # 构建policy
             expire_time = datetime.utcnow() + timedelta(minutes=10)  # 10分钟过期
@@ -1720,20 +2182,17 @@ class QwenClient:
                     {"key": file_path},
                     {"x-oss-security-token": sts_data["security_token"]},
                     ["eq", "$Content-Type", content_type],
-                    ["content-length-range", 0, 10485760]  # 最大10MB
+                    ["content-length-range", 0, MULTIPART_THRESHOLD]
                 ]
             }
             
-            # 编码policy
-            policy_encoded = base64.b64encode(json.dumps(policy_doc).encode()).decode()
+            # 编码policy（orjson 直接输出 bytes，base64 与签名都在 bytes 上完成）
+            policy_bytes = base64.b64encode(orjson.dumps(policy_doc))
+            policy_encoded = policy_bytes.decode()
             
             # 计算签名
             signature = base64.b64encode(
-                hmac.new(
-                    sts_data["access_key_secret"].encode(),
-                    policy_encoded.encode(),
-                    hashlib.sha1
-                ).digest()
+                hmac.digest(sts_data["access_key_secret"].encode(), policy_bytes, 'sha1')
             ).decode()
             
             # 构建表单数据
@@ -1754,16 +2213,18 @@ class QwenClient:
             # OSS endpoint URL
             oss_endpoint = f"https://{sts_data.get('bucketname', 'qwen-webui-prod')}.{sts_data.get('endpoint', 'oss-accelerate.aliyuncs.com')}/"
             
-            debug_log(f"POST表单上传到: {oss_endpoint}")
-            debug_log(f"表单数据: {form_data}")
+            if DEBUG_STATUS:
+                debug_log(f"POST表单上传到: {oss_endpoint}")
+                debug_log(f"表单数据: {form_data}")
             
             # 执行POST表单上传
-            response = requests.post(oss_endpoint, data=form_data, files=files)
+            response = await self.oss_session.post(oss_endpoint, data=form_data, files=files)
             
-            debug_log(f"OSS POST响应状态码: {response.status_code}")
-            debug_log(f"OSS POST响应头: {dict(response.headers)}")
+            if DEBUG_STATUS:
+                debug_log(f"OSS POST响应状态码: {response.status_code}")
+                debug_log(f"OSS POST响应头: {response.headers}")
             
-            if response.status_code >= 400:
+            if DEBUG_STATUS and response.status_code >= 400:
                 debug_log(f"OSS POST响应内容: {response.text[:500]}")
             
             if response.status_code in [200, 204]:
@@ -1784,11 +2245,17 @@ class QwenClient:
             return {"success": False, "error": str(e)}
     
 
-    async def upload_multipart_to_oss(self, file_content: bytes, sts_data: dict, filename: str, content_type: str) -> dict:
-        """OSS分块上传实现 - 基于curlvode.txt的完整流程"""
+    async def upload_multipart_to_oss(self, file_content: Union[bytes, UploadFile], sts_data: dict, filename: str, content_type: str,
+                                      chunk_size: int = 5 * 1024 * 1024) -> dict:
+        """OSS分块上传实现 - 基于curlvode.txt的完整流程
+
+        file_content 可以是完整的 bytes，也可以是 UploadFile：后者按分块边读边传，
+        不需要先把整个文件读入内存。chunk_size 为每个分块的大小（默认5MB），
+        调用方通常按文件大小用 _multipart_part_size 选择。
+        """
         try:
+            import base64
             import hashlib
-            import xml.etree.ElementTree as ET
             from datetime import datetime
             from urllib.parse import quote
 
@@ -1811,212 +2278,182 @@ class QwenClient:
             # 第1步: 初始化分块上传
             debug_log("第1步: 初始化分块上传")
             init_url = f"{oss_url}?uploads="
+            # 本次上传所有请求的 CanonicalURI 相同，只解析一次；各请求的查询串格式固定，直接拼接
+            canonical_uri, _ = _oss_canonical_uri_and_query(oss_url)
 
-            # 生成OSS v4签名 - 严格按照curlvode.txt格式
-            def generate_oss_v4_signature(method: str, url: str, headers: dict, date_str: str):
-                from urllib.parse import urlparse, parse_qs
-
-                parsed_url = urlparse(url)
-
-                # 1. CanonicalQueryString - 修复查询参数处理
-                # 对于?uploads或?uploads=这种情况，应该生成"uploads"而不是空字符串
-                if parsed_url.query:
-                    # 手动解析查询字符串，保留空值参数
-                    query_parts = []
-                    for param in parsed_url.query.split('&'):
-                        if '=' in param:
-                            key, value = param.split('=', 1)
-                            if value:
-                                query_parts.append(f"{key}={value}")
-                            else:
-                                query_parts.append(key)  # ?uploads= 情况
-                        else:
-                            query_parts.append(param)  # ?uploads 情况
-                    canonical_querystring = '&'.join(sorted(query_parts))
-                else:
-                    canonical_querystring = ''
-
-                # 2. CanonicalHeaders - 必须包含所有参与签名的headers并按字母序排列
-                # 注意：需要将headers键名转为小写进行匹配
-                headers_lower = {k.lower(): v for k, v in headers.items()}
-
-                canonical_headers_list = []
-                signed_headers_list = []
-                # 获取所有需要参与签名的headers（按字母序）
-                required_headers = ['content-md5', 'content-type', 'x-oss-content-sha256', 'x-oss-date', 'x-oss-security-token', 'x-oss-user-agent']
-                for header_name in sorted(required_headers):
-                    if header_name in headers_lower:
-                        canonical_headers_list.append(f"{header_name}:{headers_lower[header_name]}")
-                        signed_headers_list.append(header_name)
-
-                canonical_headers = '\n'.join(canonical_headers_list) + '\n'
-                signed_headers = ';'.join(signed_headers_list)
-
-                # 3. CanonicalURI - 修复URI处理（加速域名需要包含bucket名）
-                # 对于加速域名 https://bucket.oss-accelerate.aliyuncs.com/path
-                # CanonicalURI应该是 /bucket/path
-                host = parsed_url.netloc
-                path = parsed_url.path
-                if 'oss-accelerate.aliyuncs.com' in host and '.' in host:
-                    # 从host中提取bucket名
-                    bucket = host.split('.')[0]
-                    canonical_uri = f"/{bucket}{path}" if path else f"/{bucket}/"
-                else:
-                    canonical_uri = path or '/'
-
-                canonical_request = f"{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n\nUNSIGNED-PAYLOAD"
-                debug_log(f"Canonical Request: {canonical_request}")
-
-                # 4. String to Sign
-                date_parts = date_str.split('T')
-                date_scope = f"{date_parts[0]}/ap-southeast-1/oss/aliyun_v4_request"
-                string_to_sign = f"OSS4-HMAC-SHA256\n{date_str}\n{date_scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
-                debug_log(f"String to Sign: {string_to_sign}")
+            # 初始化分块上传请求 - 完全按照curlvode.txt设置headers
+            # 直接拼接整数字段（比 strftime 快），日期部分单独取出作为签名范围
+            now = datetime.utcnow()
+            date_str = f"{now.year:04d}{now.month:02d}{now.day:02d}T{now.hour:02d}{now.minute:02d}{now.second:02d}Z"
+            date_ymd = date_str[:8]
 
-                # 5. 计算签名
-                def sign(key, msg):
-                    return hmac.new(key, msg.encode() if isinstance(msg, str) else msg, hashlib.sha256).digest()
-                
-                # 使用正确的签名密钥生成方式
-                date_key = sign(f"aliyun_v4{access_key_secret}".encode(), date_parts[0])
-                region_key = sign(date_key, "ap-southeast-1")
-                service_key = sign(region_key, "oss")
-                signing_key = sign(service_key, "aliyun_v4_request")
-                signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+            # 整个分块上传（初始化/各分块/完成）共用同一个签名密钥
+            signing_key = _derive_oss_signing_key(access_key_secret, date_ymd)
 
-                # 6. Authorization Header - 严格按照curlvode.txt格式
-                return f"OSS4-HMAC-SHA256 Credential={access_key_id}/{date_scope},Signature={signature}"
-
-            # 初始化分块上传请求 - 完全按照curlvode.txt设置headers
-            date_str = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-            init_headers = {
-                'Accept': '*/*',
-                'Accept-Language': 'zh-CN,zh;q=0.9',
-                'Connection': 'keep-alive',
-                'Content-Length': '0',
-                'Content-Type': content_type,
-                'Origin': 'https://chat.qwen.ai',
-                'Referer': 'https://chat.qwen.ai/',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'cross-site',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36',
-                'sec-ch-ua': '"Not A(Brand";v="8", "Chromium";v="132", "Google Chrome";v="132"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"Windows"',
-                'x-oss-content-sha256': 'UNSIGNED-PAYLOAD',
-                'x-oss-date': date_str,
-                'x-oss-security-token': security_token,
-                'x-oss-user-agent': 'aliyun-sdk-js/6.23.0 Chrome 132.0.0.0 on Windows 10 64-bit'
-            }
+            # 本次上传所有OSS请求共享的请求头（静态部分 + 日期与STS token）
+            base_headers = {**_OSS_STATIC_HEADERS, 'x-oss-date': date_str, 'x-oss-security-token': security_token}
+            init_headers = {**base_headers, 'Content-Length': '0', 'Content-Type': content_type}
 
             # 添加authorization头
-            init_headers['authorization'] = generate_oss_v4_signature('POST', init_url, init_headers, date_str)
+            init_headers['authorization'] = _oss_v4_authorization(
+                signing_key, access_key_id, 'POST', init_url, init_headers, date_str,
+                canonical_uri=canonical_uri, canonical_query='uploads'
+            )
 
-            response = requests.post(init_url, headers=init_headers)
-            debug_log(f"初始化分块上传响应: {response.status_code}")
+            response = await self.oss_session.post(init_url, headers=init_headers)
+            if DEBUG_STATUS:
+                debug_log(f"初始化分块上传响应: {response.status_code}")
 
             if response.status_code != 200:
                 debug_log(f"初始化分块上传失败: {response.text}")
                 return {"success": False, "error": f"初始化分块上传失败: {response.status_code}"}
 
             # 解析upload_id
-            upload_root = ET.fromstring(response.content)
-            upload_id = upload_root.find('UploadId').text if upload_root.find('UploadId') is not None else None
+            upload_id_match = _UPLOAD_ID_RE.search(response.content)
+            upload_id = upload_id_match.group(1).decode() if upload_id_match else None
 
             if not upload_id:
                 return {"success": False, "error": "未能获取UploadId"}
 
-            debug_log(f"获得UploadId: {upload_id}")
+            if DEBUG_STATUS:
+                debug_log(f"获得UploadId: {upload_id}")
 
             # 第2步: 分块上传文件内容
             debug_log("第2步: 分块上传文件内容")
 
-            chunk_size = 5 * 1024 * 1024  # 5MB per chunk
-            total_size = len(file_content)
-            part_number = 1
-            parts = []
-
-            for i in range(0, total_size, chunk_size):
-                chunk = file_content[i:i + chunk_size]
-
-                # 上传分块
-                part_url = f"{oss_url}?partNumber={part_number}&uploadId={upload_id}"
-
-                part_headers = {
-                    'Accept': '*/*',
-                    'Accept-Language': 'zh-CN,zh;q=0.9',
-                    'Connection': 'keep-alive',
-                    'Content-Type': content_type,
-                    'Origin': 'https://chat.qwen.ai',
-                    'Referer': 'https://chat.qwen.ai/',
-                    'Sec-Fetch-Dest': 'empty',
-                    'Sec-Fetch-Mode': 'cors',
-                    'Sec-Fetch-Site': 'cross-site',
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36',
-                    'sec-ch-ua': '"Not A(Brand";v="8", "Chromium";v="132", "Google Chrome";v="132"',
-                    'sec-ch-ua-mobile': '?0',
-                    'sec-ch-ua-platform': '"Windows"',
-                    'x-oss-content-sha256': 'UNSIGNED-PAYLOAD',
-                    'x-oss-date': date_str,
-                    'x-oss-security-token': security_token,
-                    'x-oss-user-agent': 'aliyun-sdk-js/6.23.0 Chrome 132.0.0.0 on Windows 10 64-bit'
-                }
+            if isinstance(file_content, (bytes, bytearray)):
+                read_offset = 0
 
-                part_headers['authorization'] = generate_oss_v4_signature('PUT', part_url, part_headers, date_str)
+                async def read_chunk() -> bytes:
+                    nonlocal read_offset
+                    chunk = file_content[read_offset:read_offset + chunk_size]
+                    read_offset += chunk_size
+                    return chunk
+            else:
+                async def read_chunk() -> bytes:
+                    return await file_content.read(chunk_size)
+
+            # 多个分块并发上传，信号量限制同时在途（已读入内存）的分块数
+            semaphore = asyncio.Semaphore(self.OSS_PART_CONCURRENCY)
+            part_tasks = []
+            part_failed = asyncio.Event()
+
+            def abort_parts():
+                # 任一分块失败后停止读取后续分块，并取消其他仍在上传的分块
+                part_failed.set()
+                current = asyncio.current_task()
+                for task in part_tasks:
+                    if task is not current:
+                        task.cancel()
+
+            async def upload_part(part_number: int, chunk: bytes):
+                # 调用方读取分块前已获取信号量，分块的哈希、签名与上传全部在 try 中，异常或取消时都会释放
+                try:
+                    # 上传分块
+                    # partNumber 按字典序排在 uploadId 之前，本身即是规范化后的查询串
+                    part_query = f"partNumber={part_number}&uploadId={upload_id}"
+                    part_url = f"{oss_url}?{part_query}"
+
+                    # Content-MD5 让OSS校验分块完整性；hashlib 在计算大块数据时释放GIL，
+                    # 放到线程中计算，不阻塞事件循环上其他分块的传输
+                    part_md5 = await asyncio.to_thread(hashlib.md5, chunk)
+                    part_headers = {
+                        **base_headers,
+                        'Content-MD5': base64.b64encode(part_md5.digest()).decode(),
+                        'Content-Type': content_type
+                    }
 
-                part_response = requests.put(part_url, data=chunk, headers=part_headers)
-                debug_log(f"上传分块{part_number}响应: {part_response.status_code}")
+                    part_headers['authorization'] = _oss_v4_authorization(
+                        signing_key, access_key_id, 'PUT', part_url, part_headers, date_str,
+                        canonical_uri=canonical_uri, canonical_query=part_query
+                    )
+
+                    # 单个分块失败时只重试该分块（指数退避），不让整个上传失败
+                    for attempt in range(self.OSS_PART_RETRIES + 1):
+                        if attempt:
+                            await asyncio.sleep(self.OSS_PART_RETRY_BACKOFF * 2 ** (attempt - 1))
+                        try:
+                            part_response = await self.oss_session.put(part_url, content=chunk, headers=part_headers)
+                        except httpx.TransportError as e:
+                            if attempt == self.OSS_PART_RETRIES:
+                                raise
+                            debug_log(f"分块{part_number}上传网络错误，准备重试: {e}")
+                            continue
+                        if part_response.status_code < 500 and part_response.status_code != 429:
+                            break
+                        debug_log(f"分块{part_number}上传响应 {part_response.status_code}，准备重试")
+                except BaseException:
+                    abort_parts()
+                    raise
+                finally:
+                    semaphore.release()
+                if DEBUG_STATUS:
+                    debug_log(f"上传分块{part_number}响应: {part_response.status_code}")
 
                 if part_response.status_code not in [200, 201]:
+                    abort_parts()
                     debug_log(f"分块{part_number}上传失败: {part_response.text}")
-                    return {"success": False, "error": f"分块{part_number}上传失败"}
+                    return None
 
                 # 获取ETag
                 etag = part_response.headers.get('ETag', '').strip('"')
-                parts.append({'PartNumber': part_number, 'ETag': etag})
-                debug_log(f"分块{part_number}上传成功, ETag: {etag}")
-
-                part_number += 1
+                if DEBUG_STATUS:
+                    debug_log(f"分块{part_number}上传成功, ETag: {etag}")
+                return {'PartNumber': part_number, 'ETag': etag}
+
+            # 顺序读取分块：拿到信号量后才读入下一块，读到的分块立即开始上传；已有分块失败时不再继续读取
+            try:
+                while not part_failed.is_set():
+                    await semaphore.acquire()
+                    if part_failed.is_set():
+                        semaphore.release()
+                        break
+                    chunk = await read_chunk()
+                    if not chunk:
+                        semaphore.release()
+                        break
+                    part_tasks.append(asyncio.create_task(upload_part(len(part_tasks) + 1, chunk)))
+                parts = await asyncio.gather(*part_tasks, return_exceptions=True)
+            except BaseException:
+                for task in part_tasks:
+                    task.cancel()
+                raise
+            # 按分块顺序报告第一个失败（被 abort_parts 取消的分块跳过）
+            for part_number, part in enumerate(parts, start=1):
+                if part is None:
+                    return {"success": False, "error": f"分块{part_number}上传失败"}
+                if isinstance(part, BaseException) and not isinstance(part, asyncio.CancelledError):
+                    raise part
 
             # 第3步: 完成分块上传
             debug_log("第3步: 完成分块上传")
 
-            complete_url = f"{oss_url}?uploadId={upload_id}"
+            complete_query = f"uploadId={upload_id}"
+            complete_url = f"{oss_url}?{complete_query}"
 
             # 构建完成上传的XML - 完全按照curlvode.txt格式
-            complete_xml = '<?xml version="1.0" encoding="UTF-8"?>\n<CompleteMultipartUpload>\n'
-            for part in parts:
-                complete_xml += f'<Part>\n<PartNumber>{part["PartNumber"]}</PartNumber>\n<ETag>"{part["ETag"]}"</ETag>\n</Part>\n'
-            complete_xml += '</CompleteMultipartUpload>'
+            complete_xml = b"".join((
+                b'<?xml version="1.0" encoding="UTF-8"?>\n<CompleteMultipartUpload>\n',
+                *(f'<Part>\n<PartNumber>{part["PartNumber"]}</PartNumber>\n<ETag>"{part["ETag"]}"</ETag>\n</Part>\n'.encode()
+                  for part in parts),
+                b'</CompleteMultipartUpload>'
+            ))
 
             # 设置完成上传的headers - 完全按照curlvode.txt
-            import base64
             complete_headers = {
-                'Accept': '*/*',
-                'Accept-Language': 'zh-CN,zh;q=0.9',
-                'Connection': 'keep-alive',
-                'Content-MD5': base64.b64encode(hashlib.md5(complete_xml.encode()).digest()).decode(),
-                'Content-Type': 'application/xml',
-                'Origin': 'https://chat.qwen.ai',
-                'Referer': 'https://chat.qwen.ai/',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'cross-site',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36',
-                'sec-ch-ua': '"Not A(Brand";v="8", "Chromium";v="132", "Google Chrome";v="132"',
-                'sec-ch-ua-mobile': '?0',
-                'sec-ch-ua-platform': '"Windows"',
-                'x-oss-content-sha256': 'UNSIGNED-PAYLOAD',
-                'x-oss-date': date_str,
-                'x-oss-security-token': security_token,
-                'x-oss-user-agent': 'aliyun-sdk-js/6.23.0 Chrome 132.0.0.0 on Windows 10 64-bit'
+                **base_headers,
+                'Content-MD5': base64.b64encode(hashlib.md5(complete_xml).digest()).decode(),
+                'Content-Type': 'application/xml'
             }
 
-            complete_headers['authorization'] = generate_oss_v4_signature('POST', complete_url, complete_headers, date_str)
+            complete_headers['authorization'] = _oss_v4_authorization(
+                signing_key, access_key_id, 'POST', complete_url, complete_headers, date_str,
+                canonical_uri=canonical_uri, canonical_query=complete_query
+            )
 
-            complete_response = requests.post(complete_url, data=complete_xml, headers=complete_headers)
-            debug_log(f"完成分块上传响应: {complete_response.status_code}")
+            complete_response = await self.oss_session.post(complete_url, content=complete_xml, headers=complete_headers)
+            if DEBUG_STATUS:
+                debug_log(f"完成分块上传响应: {complete_response.status_code}")
 
             if complete_response.status_code not in [200, 201]:
                 debug_log(f"完成分块上传失败: {complete_response.text}")
@@ -2111,12 +2548,78 @@ class VideoChatRequest(BaseModel):
     thinking_budget: Optional[int] = None
 
 # --- FastAPI 应用 ---
+class ORJSONResponse(JSONResponse):
+    """使用 orjson 序列化的 JSON 响应，直接输出 bytes，比标准库 json 更快"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+# 图片上传接口允许的最大图片大小
+IMAGE_MAX_SIZE = 10 * 1024 * 1024  # 10MB
+
+class UploadSizeLimitMiddleware:
+    """按 Content-Length 提前拒绝过大的上传请求（纯ASGI中间件）
+
+    FastAPI 会在调用接口函数之前解析完整个 multipart 请求体，接口内的大小校验
+    只能在请求体全部接收之后进行；这里在读取请求体之前检查 Content-Length，
+    直接返回 413。multipart 信封比文件本身略大，因此上限放宽 10%；
+    没有 Content-Length 的请求仍由接口内的大小校验兜底。
+    """
+
+    # 路径 -> (文件大小上限, 表单字段名)
+    LIMITS = {
+        "/v1/image/upload_and_chat": (IMAGE_MAX_SIZE, "image"),
+    }
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            limit = self.LIMITS.get(scope["path"])
+            if limit is not None:
+                max_size, param = limit
+                for name, value in scope["headers"]:
+                    if name == b"content-length":
+                        if value.isdigit() and int(value) > max_size * 11 // 10:
+                            response = ORJSONResponse(
+                                {"detail": {"error": {
+                                    "message": f"上传文件过大，最大支持 {max_size / (1024 * 1024):.0f}MB",
+                                    "type": "invalid_request_error",
+                                    "param": param,
+                                    "code": "file_too_large"
+                                }}},
+                                status_code=413
+                            )
+                            await response(scope, receive, send)
+                            return
+                        break
+        await self.app(scope, receive, send)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时初始化客户端、数据库并同步云端历史记录，关闭时释放HTTP客户端与数据库连接"""
+    await qwen_client._initialize()
+    await qwen_client.history_manager.init_database()
+    # 多个工作进程同时启动时只同步一次，避免并发清空/重建会话表并重复请求云端历史
+    if qwen_client.history_manager.acquire_sync_lock():
+        await qwen_client.sync_history_from_cloud()
+    else:
+        debug_log("其他工作进程已负责同步云端历史记录，跳过")
+    yield
+    await qwen_client.close()
+
 app = FastAPI(
     title="Qwen OpenAI API Proxy",
     description="千问 (Qwen) OpenAI API 代理",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+# 在解析请求体之前按 Content-Length 拒绝过大的上传（先注册，位于 CORS 内层，413 响应同样带 CORS 头）
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # 配置 CORS
 app.add_middleware(
     CORSMiddleware,
@@ -2126,6 +2629,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request: Request, exc: HTTPException):
+    """HTTPException 同样使用 orjson 序列化（FastAPI 默认处理器使用标准库 json），响应格式保持不变"""
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=headers)
+
 # 初始化客户端
 qwen_client = QwenClient(auth_token=QWEN_AUTH_TOKEN, cookies=QWEN_COOKIES)
 
@@ -2154,15 +2665,8 @@ async def list_models():
                 }
             )
         
-        # 从已获取的模型信息构造 OpenAI 格式列表
-        openai_models = []
-        for model_id, model_info in qwen_client.models_info.items():
-            openai_models.append(ModelInfo(
-                id=model_info['info']['id'],
-                created=model_info['info']['created_at'],
-                owned_by=model_info['owned_by']
-            ))
-        return ModelsResponse(data=openai_models)
+        # 模型列表很少变化，直接返回缓存的序列化结果
+        return Response(content=qwen_client.models_response_body(), media_type="application/json")
     except Exception as e:
         logger.debug(f"列出模型时出错: {e}")
         raise HTTPException(
@@ -2178,9 +2682,9 @@ async def list_models():
         )
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, auth_token: str = Depends(verify_auth_token)):
+async def chat_completions(request: ChatCompletionRequest, auth_token: str = AUTH):
     """处理 OpenAI 兼容的聊天补全请求"""
-    openai_request = request.dict()
+    openai_request = request.model_dump()
     
     try:
         result = await qwen_client.chat_completions(openai_request)
@@ -2211,7 +2715,7 @@ async def chat_completions(request: ChatCompletionRequest, auth_token: str = Dep
 async def delete_chat(chat_id: str):
     """删除指定的对话"""
     try:
-        success = qwen_client.delete_chat(chat_id)
+        success = await qwen_client.delete_chat(chat_id)
         if success:
             return {"message": f"会话 {chat_id} 已删除", "success": True}
         else:
@@ -2233,6 +2737,15 @@ async def delete_chat(chat_id: str):
             }
         )
 
+@app.get("/v1/chats/export", dependencies=[AUTH])
+async def export_chats():
+    """以 NDJSON 格式流式导出本地会话记录，逐行发送而不在内存中缓存完整结果"""
+    async def generate():
+        async for session in qwen_client.history_manager.iter_sessions():
+            yield orjson.dumps(session) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @app.get("/")
 async def index():
     """根路径，返回 API 信息"""
@@ -2274,25 +2787,33 @@ async def get_sts_token(request: FileUploadRequest):
         )
 
 @app.post("/v1/files/upload")
-async def upload_file(file: UploadFile = File(...), auth_token: str = Depends(verify_auth_token)):
+async def upload_file(file: UploadFile = File(...), auth_token: str = AUTH):
     """上传文件接口（支持多种文件格式：图片、文档、表格、文本等）"""
     try:
         # 使用辅助函数确定文件类型
         filetype = determine_filetype(file.filename or "", file.content_type)
-        debug_log(f"文件类型检测: {file.filename} -> Content-Type: {file.content_type} -> filetype: {filetype}")
+        if DEBUG_STATUS:
+            debug_log(f"文件类型检测: {file.filename} -> Content-Type: {file.content_type} -> filetype: {filetype}")
         
-        # 读取文件内容
-        file_content = await file.read()
-        file_size = len(file_content)
+        # 文件大小（不预先把整个文件读入内存）
+        file_size = upload_file_size(file)
+
+        # 根据文件大小和类型，决定使用普通上传还是分块上传
+        use_multipart = _use_multipart_upload(file_size, filetype)
         
-        # 获取STS Token
-        sts_result = await qwen_client.get_sts_token(
+        # 获取STS Token；POST表单上传需要完整的文件内容，与STS请求并发读取
+        sts_request = qwen_client.get_sts_token(
             filename=file.filename or "uploaded_file",
             filesize=file_size,
             filetype=filetype
         )
+        if use_multipart:
+            sts_result = await sts_request
+        else:
+            sts_result, file_content = await asyncio.gather(sts_request, file.read())
         
-        debug_log(f"STS结果: {sts_result}")
+        if DEBUG_STATUS:
+            debug_log(f"STS结果: {sts_result}")
         
         # 检查STS响应结构
         if not sts_result.get("success", False):
@@ -2308,7 +2829,8 @@ async def upload_file(file: UploadFile = File(...), auth_token: str = Depends(ve
                 detail={"error": {"message": "获取上传授权失败：响应数据为空", "type": "sts_error"}}
             )
         
-        debug_log(f"STS数据: {sts_data}")
+        if DEBUG_STATUS:
+            debug_log(f"STS数据: {sts_data}")
         
         # 检查必需的字段是否存在
         required_fields = ["access_key_id", "access_key_secret", "security_token"]
@@ -2320,30 +2842,31 @@ async def upload_file(file: UploadFile = File(...), auth_token: str = Depends(ve
             )
         
         # 检查STS响应中的上传信息
-        debug_log(f"完整STS数据: {sts_data}")
+        if DEBUG_STATUS:
+            debug_log(f"完整STS数据: {sts_data}")
 
         # 使用辅助函数确定详细Content-Type
         content_type = determine_content_type(file.filename or "", file.content_type)
-        debug_log(f"最终Content-Type: {content_type}")
+        if DEBUG_STATUS:
+            debug_log(f"最终Content-Type: {content_type}")
 
-        # 根据文件大小和类型，决定使用普通上传还是分块上传
-        MULTIPART_THRESHOLD = 5 * 1024 * 1024  # 5MB
-        use_multipart = filetype == "video" or file_size > MULTIPART_THRESHOLD
-
-        debug_log(f"文件大小: {file_size} bytes, 文件类型: {filetype}, 使用分块上传: {use_multipart}")
+        if DEBUG_STATUS:
+            debug_log(f"文件大小: {file_size} bytes, 文件类型: {filetype}, 使用分块上传: {use_multipart}")
 
         if use_multipart:
             debug_log("使用OSS分块上传处理大文件/视频文件")
+            # 直接从 UploadFile 按分块读取并上传
             upload_result = await qwen_client.upload_multipart_to_oss(
-                file_content,
+                file,
                 sts_data,
                 file.filename or "uploaded_file",
-                content_type
+                content_type,
+                chunk_size=_multipart_part_size(file_size)
             )
         else:
             # 使用POST表单上传（已验证成功的方案）- 参考qwen_fastapi20250930.py
             debug_log("使用POST表单上传（小文件）")
-            upload_result = qwen_client.upload_with_oss_post_form(
+            upload_result = await qwen_client.upload_with_oss_post_form(
                 file_content,
                 sts_data["file_path"],
                 content_type,
@@ -2353,25 +2876,28 @@ async def upload_file(file: UploadFile = File(...), auth_token: str = Depends(ve
         
         if upload_result["success"]:
             # 详细调试 STS 数据和 URL 信息
-            debug_log(f"=== URL 生成调试信息 ===")
-            debug_log(f"STS数据中的file_url: {sts_data.get('file_url', '未提供')}")
-            debug_log(f"上传结果URL: {upload_result.get('url', '未提供')}")
+            if DEBUG_STATUS:
+                debug_log("=== URL 生成调试信息 ===")
+                debug_log(f"STS数据中的file_url: {sts_data.get('file_url', '未提供')}")
+                debug_log(f"上传结果URL: {upload_result.get('url', '未提供')}")
             
             # 关键修复：优先使用STS响应中的预签名URL，确保外部访问权限
             # sts_data["file_url"] 包含完整的签名参数，支持外部下载和AI访问
             if "file_url" in sts_data and sts_data["file_url"]:
                 file_access_url = sts_data["file_url"]  # 使用带签名的预签名URL
-                debug_log(f"✅ 使用STS预签名URL（推荐）")
+                debug_log("✅ 使用STS预签名URL（推荐）")
             else:
                 file_access_url = upload_result["url"]  # 降级使用上传结果URL
-                debug_log(f"⚠️  降级使用上传结果URL（可能无外部访问权限）")
+                debug_log("⚠️  降级使用上传结果URL（可能无外部访问权限）")
             
-            debug_log(f"最终文件访问URL: {file_access_url}")
-            debug_log(f"URL类型: {'预签名URL(带签名)' if 'x-oss-signature' in file_access_url else '基础URL(无签名)'}")
-            debug_log(f"========================")
+            if DEBUG_STATUS:
+                debug_log(f"最终文件访问URL: {file_access_url}")
+                debug_log(f"URL类型: {'预签名URL(带签名)' if 'x-oss-signature' in file_access_url else '基础URL(无签名)'}")
+                debug_log("========================")
             
+            file_id = sts_data.get("file_id")
             return {
-                "id": sts_data.get("file_id", str(uuid.uuid4())),
+                "id": file_id if file_id is not None else str(uuid.uuid4()),
                 "object": "file", 
                 "bytes": file_size,
                 "created_at": int(time.time()),
@@ -2408,11 +2934,11 @@ async def upload_file(file: UploadFile = File(...), auth_token: str = Depends(ve
         )
 
 @app.post("/v1/chat/multimodal")
-async def multimodal_chat_completions(request: MultiModalChatRequest, auth_token: str = Depends(verify_auth_token)):
+async def multimodal_chat_completions(request: MultiModalChatRequest, auth_token: str = AUTH):
     """处理多模态聊天补全请求 - 支持图片、PDF、Word、Excel、TXT等多种文件格式"""
     try:
         # 直接调用新的多模态方法，不再做转换
-        openai_request = request.dict()
+        openai_request = request.model_dump()
 
         result = await qwen_client.multimodal_chat_completions(openai_request)
 
@@ -2437,7 +2963,7 @@ async def multimodal_chat_completions(request: MultiModalChatRequest, auth_token
             }
         )
 
-@app.post("/v1/image/upload_and_chat", dependencies=[Depends(verify_auth_token)])
+@app.post("/v1/image/upload_and_chat", dependencies=[AUTH])
 async def upload_image_and_chat(
     image: UploadFile = File(...),
     model: str = Form("qwen3-vl-plus"),
@@ -2445,7 +2971,7 @@ async def upload_image_and_chat(
     stream: bool = Form(False),
     enable_thinking: bool = Form(False),
     thinking_budget: Optional[int] = Form(None),
-    auth_token: str = Depends(verify_auth_token)
+    auth_token: str = AUTH
 ):
     """上传图片文件到OSS并基于该图片发起一次多模态聊天（一体化接口）
 
@@ -2471,12 +2997,11 @@ async def upload_image_and_chat(
         ```
     """
     try:
-        # 读取图片内容
-        content = await image.read()
-        size = len(content)
+        # 图片大小（不预先读入内存，分块上传时直接从 UploadFile 按块读取）
+        size = upload_file_size(image)
 
         # 验证文件大小（建议不超过 10MB）
-        max_size = 10 * 1024 * 1024  # 10MB
+        max_size = IMAGE_MAX_SIZE
         if size > max_size:
             raise HTTPException(
                 status_code=400,
@@ -2492,31 +3017,26 @@ async def upload_image_and_chat(
 
         # 获取文件扩展名和 Content-Type
         filename = image.filename or "image.jpg"
-        file_ext = os.path.splitext(filename)[1].lower()
-
-        # 图片格式映射
-        image_content_types = {
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.webp': 'image/webp',
-            '.bmp': 'image/bmp',
-            '.tiff': 'image/tiff',
-            '.svg': 'image/svg+xml',
-            '.ico': 'image/x-icon'
-        }
+        content_type = _IMAGE_EXT_TO_MIME.get(_file_ext(filename), image.content_type or 'image/jpeg')
 
-        content_type = image_content_types.get(file_ext, image.content_type or 'image/jpeg')
+        if DEBUG_STATUS:
+            debug_log(f"上传图片: {filename}, 大小: {size} bytes, 类型: {content_type}")
 
-        debug_log(f"上传图片: {filename}, 大小: {size} bytes, 类型: {content_type}")
+        # 选择上传策略：
+        # - 图片 ≤5MB: 使用POST表单上传
+        # - 图片 >5MB: 使用分块上传
+        use_multipart = _use_multipart_upload(size, "image")
 
-        # 获取STS授权（filetype=image）
-        sts_result = await qwen_client.get_sts_token(
+        # 获取STS授权（filetype=image）；POST表单上传需要完整的图片内容，与STS请求并发读取
+        sts_request = qwen_client.get_sts_token(
             filename=filename,
             filesize=size,
             filetype="image"
         )
+        if use_multipart:
+            sts_result = await sts_request
+        else:
+            sts_result, content = await asyncio.gather(sts_request, image.read())
 
         if not sts_result.get("success"):
             raise HTTPException(
@@ -2531,134 +3051,101 @@ async def upload_image_and_chat(
 
         sts_data = sts_result.get("data", {})
 
-        # 选择上传策略：
-        # - 图片 <5MB: 使用直接 PUT 上传
-        # - 图片 ≥5MB: 使用分块上传
-        if size >= 5 * 1024 * 1024:  # 5MB
-            debug_log(f"图片文件 ≥5MB，使用分块上传")
-            upload_result = await qwen_client.upload_multipart_to_oss(
-                content, sts_data, filename, content_type
-            )
-        else:
-            debug_log(f"图片文件 <5MB，使用POST表单上传")
-            upload_result = qwen_client.upload_with_oss_post_form(
-                content,
-                sts_data["file_path"],
-                content_type,
-                sts_data,
-                filename
-            )
-
-        if not upload_result.get("success"):
-            # 尝试备用方案
-            if size >= 5 * 1024 * 1024:
-                debug_log("分块上传失败，尝试POST表单上传")
-                upload_result = qwen_client.upload_with_oss_post_form(
+        # 上传期间并发创建多模态会话（交给 multimodal_chat_completions 之前出错时在后台删除该会话）
+        chat_task = qwen_client.prepare_multimodal_chat(model)
+        try:
+            if use_multipart:
+                debug_log("图片文件 >5MB，使用分块上传")
+                upload_result = await qwen_client.upload_multipart_to_oss(
+                    image, sts_data, filename, content_type, chunk_size=_multipart_part_size(size)
+                )
+            else:
+                debug_log("图片文件 ≤5MB，使用POST表单上传")
+                upload_result = await qwen_client.upload_with_oss_post_form(
                     content,
                     sts_data["file_path"],
                     content_type,
                     sts_data,
                     filename
                 )
-            else:
-                debug_log("直接上传失败，尝试分块上传")
-                upload_result = await qwen_client.upload_multipart_to_oss(
-                    content, sts_data, filename, content_type
-                )
 
             if not upload_result.get("success"):
+                # 尝试备用方案（超过POST表单上限的文件没有备用方案，OSS会直接拒绝）
+                if not use_multipart:
+                    debug_log("直接上传失败，尝试分块上传")
+                    upload_result = await qwen_client.upload_multipart_to_oss(
+                        content, sts_data, filename, content_type
+                    )
+
+                if not upload_result.get("success"):
+                    raise HTTPException(
+                        status_code=500,
+                        detail={
+                            "error": {
+                                "message": upload_result.get("error", "图片上传失败"),
+                                "type": "upload_error"
+                            }
+                        }
+                    )
+
+            # 构造可访问URL（优先使用STS的预签名URL）
+            file_access_url = sts_data.get("file_url") or upload_result.get("url")
+            if not file_access_url:
                 raise HTTPException(
                     status_code=500,
                     detail={
                         "error": {
-                            "message": upload_result.get("error", "图片上传失败"),
+                            "message": "未获取到图片访问URL",
                             "type": "upload_error"
                         }
                     }
                 )
 
-        # 构造可访问URL（优先使用STS的预签名URL）
-        file_access_url = sts_data.get("file_url") or upload_result.get("url")
-        if not file_access_url:
-            raise HTTPException(
-                status_code=500,
-                detail={
-                    "error": {
-                        "message": "未获取到图片访问URL",
-                        "type": "upload_error"
-                    }
-                }
+            if DEBUG_STATUS:
+                debug_log(f"图片上传成功，URL: {file_access_url[:80]}...")
+            # ✅ 构造完整的文件信息对象（而不是仅传递URL）
+            complete_file_info = qwen_client.build_file_info(
+                file_id=sts_data.get("file_id"),
+                filename=filename,
+                size=size,  # ✅ 使用真实文件大小
+                content_type=content_type,
+                url=file_access_url,
+                file_type="image",  # 当前接口专用于图片
+                show_type="image",
+                file_class="vision"
             )
 
-        debug_log(f"图片上传成功，URL: {file_access_url[:80]}...")
-
-        # ✅ 构造完整的文件信息对象（而不是仅传递URL）
-        file_id = sts_data.get("file_id", str(uuid.uuid4()))
-
-        # 确定文件类型和类别
-        file_type = "image"  # 当前接口专用于图片
-        show_type = "image"
-        file_class = "vision"
-
-        # 构造符合 Qwen API 格式的完整文件信息
-        complete_file_info = {
-            "type": file_type,
-            "file": {
-                "created_at": int(time.time() * 1000),
-                "data": {},
-                "filename": filename,
-                "hash": None,
-                "id": file_id,
-                "user_id": qwen_client.user_info.get('id', 'unknown') if qwen_client.user_info else 'unknown',
-                "meta": {
-                    "name": filename,
-                    "size": size,  # ✅ 使用真实文件大小
-                    "content_type": content_type
-                },
-                "update_at": int(time.time() * 1000)
-            },
-            "id": file_id,
-            "url": file_access_url,
-            "name": filename,
-            "collection_name": "",
-            "progress": 0,
-            "status": "uploaded",
-            "greenNet": "success",
-            "size": size,  # ✅ 使用真实文件大小
-            "error": "",
-            "itemId": str(uuid.uuid4()),
-            "file_type": content_type,
-            "showType": show_type,
-            "file_class": file_class,
-            "uploadTaskId": str(uuid.uuid4())
-        }
-
-        # 构造多模态消息 - 传入完整文件信息
-        messages = [
-            MultiModalMessage(
-                role="user",
-                content=[
-                    {"type": "text", "text": prompt},
+            # 构造多模态请求 - 传入完整文件信息
+            # 各字段均已由表单参数校验，直接构造 multimodal_chat_completions 所需的字典，
+            # 不再经过 MultiModalChatRequest 模型构造与 model_dump 的往返
+            chat_request = {
+                "model": model,
+                "messages": [
                     {
-                        "type": "image_url",
-                        "image_url": {"url": file_access_url},
-                        "file_info": complete_file_info  # ✅ 传入完整文件信息
-                    },
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {
+                                "type": "image_url",
+                                "image_url": {"url": file_access_url},
+                                "file_info": complete_file_info  # ✅ 传入完整文件信息
+                            },
+                        ],
+                    }
                 ],
-            )
-        ]
-
-        chat_req = MultiModalChatRequest(
-            model=model,
-            messages=messages,
-            stream=stream,
-            enable_thinking=enable_thinking,
-            thinking_budget=thinking_budget,
-        )
+                "stream": stream,
+                "enable_thinking": enable_thinking,
+                "thinking_budget": thinking_budget,
+            }
+        except BaseException:
+            if chat_task is not None:
+                qwen_client.discard_prepared_chat(chat_task)
+            raise
 
-        debug_log(f"发起多模态对话，模型: {model}, 流式: {stream}")
+        if DEBUG_STATUS:
+            debug_log(f"发起多模态对话，模型: {model}, 流式: {stream}")
 
-        result = await qwen_client.multimodal_chat_completions(chat_req.dict())
+        result = await qwen_client.multimodal_chat_completions(chat_request, new_chat=chat_task)
 
         if stream:
             return StreamingResponse(result, media_type='text/event-stream')
@@ -2682,7 +3169,7 @@ async def upload_image_and_chat(
         )
 
 
-@app.post("/v1/video/upload_and_chat", dependencies=[Depends(verify_auth_token)])
+@app.post("/v1/video/upload_and_chat", dependencies=[AUTH])
 async def upload_video_and_chat(
     video: UploadFile = File(...),
     model: str = Form("qwen3-vl-plus"),
@@ -2690,16 +3177,15 @@ async def upload_video_and_chat(
     stream: bool = Form(True),
     enable_thinking: bool = Form(False),
     thinking_budget: Optional[int] = Form(None),
-    auth_token: str = Depends(verify_auth_token)
+    auth_token: str = AUTH
 ):
     """上传视频文件到OSS并基于该视频发起一次多模态聊天。
     - 使用与 curlvode.txt 一致的分块上传流程（视频或大文件）
     - 将生成的可访问URL作为 files 中的 video 项传给 /api/v2/chat/completions
     """
     try:
-        # 读取视频内容
-        content = await video.read()
-        size = len(content)
+        # 视频大小（不预先读入内存，分块上传时直接从 UploadFile 按块读取）
+        size = upload_file_size(video)
 
         # 获取STS授权（filetype=video）
         sts_result = await qwen_client.get_sts_token(
@@ -2711,96 +3197,77 @@ async def upload_video_and_chat(
             raise HTTPException(status_code=500, detail={"error": {"message": "获取上传授权失败", "type": "sts_error"}})
         sts_data = sts_result.get("data", {})
 
-        # 选择上传策略：视频或超过5MB使用分块上传
-        content_type = video.content_type or "video/mp4"
-        use_multipart = True
-        upload_result = await qwen_client.upload_multipart_to_oss(content, sts_data, video.filename or "video.mp4", content_type)
-
-        if not upload_result.get("success"):
-            # 回退到POST表单上传（小概率）
-            upload_result = qwen_client.upload_with_oss_post_form(
-                content,
-                sts_data["file_path"],
-                content_type,
-                sts_data,
-                video.filename or "video.mp4"
+        # 上传期间并发创建多模态会话（交给 multimodal_chat_completions 之前出错时在后台删除该会话）
+        chat_task = qwen_client.prepare_multimodal_chat(model)
+        try:
+            # 选择上传策略：视频或超过5MB使用分块上传
+            content_type = video.content_type or "video/mp4"
+            use_multipart = True
+            upload_result = await qwen_client.upload_multipart_to_oss(
+                video, sts_data, video.filename or "video.mp4", content_type, chunk_size=_multipart_part_size(size)
             )
+
+            if not upload_result.get("success") and size <= MULTIPART_THRESHOLD:
+                # 回退到POST表单上传（小概率，仅限不超过POST表单上限的文件）
+                await video.seek(0)
+                upload_result = await qwen_client.upload_with_oss_post_form(
+                    await video.read(),
+                    sts_data["file_path"],
+                    content_type,
+                    sts_data,
+                    video.filename or "video.mp4"
+                )
             if not upload_result.get("success"):
                 raise HTTPException(status_code=500, detail={"error": {"message": upload_result.get("error", "上传失败"), "type": "upload_error"}})
 
-        # 构造可访问URL（优先使用STS的预签名URL）
-        file_access_url = sts_data.get("file_url") or upload_result.get("url")
-        if not file_access_url:
-            raise HTTPException(status_code=500, detail={"error": {"message": "未获取到文件访问URL", "type": "upload_error"}})
-
-        debug_log(f"视频上传成功，URL: {file_access_url[:80]}...")
-
-        # ✅ 构造完整的文件信息对象（而不是仅传递URL）
-        file_id = sts_data.get("file_id", str(uuid.uuid4()))
-        filename = video.filename or "video.mp4"
-
-        # 确定文件类型和类别
-        file_type = "video"  # 当前接口专用于视频
-        show_type = "video"
-        file_class = "video"
-
-        # 构造符合 Qwen API 格式的完整文件信息
-        complete_file_info = {
-            "type": file_type,
-            "file": {
-                "created_at": int(time.time() * 1000),
-                "data": {},
-                "filename": filename,
-                "hash": None,
-                "id": file_id,
-                "user_id": qwen_client.user_info.get('id', 'unknown') if qwen_client.user_info else 'unknown',
-                "meta": {
-                    "name": filename,
-                    "size": size,  # ✅ 使用真实文件大小
-                    "content_type": content_type
-                },
-                "update_at": int(time.time() * 1000)
-            },
-            "id": file_id,
-            "url": file_access_url,
-            "name": filename,
-            "collection_name": "",
-            "progress": 0,
-            "status": "uploaded",
-            "greenNet": "success",
-            "size": size,  # ✅ 使用真实文件大小
-            "error": "",
-            "itemId": str(uuid.uuid4()),
-            "file_type": content_type,
-            "showType": show_type,
-            "file_class": file_class,
-            "uploadTaskId": str(uuid.uuid4())
-        }
+            # 构造可访问URL（优先使用STS的预签名URL）
+            file_access_url = sts_data.get("file_url") or upload_result.get("url")
+            if not file_access_url:
+                raise HTTPException(status_code=500, detail={"error": {"message": "未获取到文件访问URL", "type": "upload_error"}})
+
+            if DEBUG_STATUS:
+                debug_log(f"视频上传成功，URL: {file_access_url[:80]}...")
+            # ✅ 构造完整的文件信息对象（而不是仅传递URL）
+            filename = video.filename or "video.mp4"
+            complete_file_info = qwen_client.build_file_info(
+                file_id=sts_data.get("file_id"),
+                filename=filename,
+                size=size,  # ✅ 使用真实文件大小
+                content_type=content_type,
+                url=file_access_url,
+                file_type="video",  # 当前接口专用于视频
+                show_type="video",
+                file_class="video"
+            )
 
-        # 构造多模态消息 - 传入完整文件信息
-        messages = [
-            MultiModalMessage(
-                role="user",
-                content=[
-                    {"type": "text", "text": prompt},
+            # 构造多模态请求 - 传入完整文件信息
+            # 各字段均已由表单参数校验，直接构造 multimodal_chat_completions 所需的字典，
+            # 不再经过 MultiModalChatRequest 模型构造与 model_dump 的往返
+            chat_request = {
+                "model": model,
+                "messages": [
                     {
-                        "type": "video_url",
-                        "video_url": {"url": file_access_url},
-                        "file_info": complete_file_info  # ✅ 传入完整文件信息
-                    },
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {
+                                "type": "video_url",
+                                "video_url": {"url": file_access_url},
+                                "file_info": complete_file_info  # ✅ 传入完整文件信息
+                            },
+                        ],
+                    }
                 ],
-            )
-        ]
-
-        chat_req = MultiModalChatRequest(
-            model=model,
-            messages=messages,
-            stream=stream,
-            enable_thinking=enable_thinking,
-            thinking_budget=thinking_budget,
-        )
+                "stream": stream,
+                "enable_thinking": enable_thinking,
+                "thinking_budget": thinking_budget,
+            }
+        except BaseException:
+            if chat_task is not None:
+                qwen_client.discard_prepared_chat(chat_task)
+            raise
 
-        result = await qwen_client.multimodal_chat_completions(chat_req.dict())
+        result = await qwen_client.multimodal_chat_completions(chat_request, new_chat=chat_task)
         return StreamingResponse(result, media_type='text/event-stream') if stream else result
 
     except HTTPException:
@@ -2820,7 +3287,18 @@ async def upload_video_and_chat(
         )
 
 if __name__ == '__main__':
+    import argparse
     import uvicorn
+    parser = argparse.ArgumentParser(description="Qwen API 代理服务")
+    # 仅写 --workers 时按CPU核数启动多个进程
+    parser.add_argument("--workers", type=int, nargs="?", const=os.cpu_count(), default=1,
+                        help="工作进程数（默认1；只写 --workers 则使用CPU核数）")
+    args = parser.parse_args()
     logger.debug(f"正在启动服务器于端口 {PORT}...")
     logger.debug(f"Debug模式: {'开启' if DEBUG_STATUS else '关闭'}")
-    uvicorn.run(app, host='0.0.0.0', port=PORT)
+    # 事件循环与HTTP解析器使用 uvicorn 默认的 "auto"：已安装 uvloop/httptools 时自动启用
+    if args.workers > 1:
+        # 多进程模式下 uvicorn 需要以导入字符串的形式加载应用
+        uvicorn.run("qwen_reverse_fastapi:app", host='0.0.0.0', port=PORT, workers=args.workers)
+    else:
+        uvicorn.run(app, host='0.0.0.0', port=PORT)